@@ -0,0 +1,98 @@
+"""Compares the size and parse time of a dataRequest response in the data point and compact encodings
+
+Example:
+    python benchmarks/compact_protocol.py --columns 10 50 200
+"""
+import argparse
+import random
+import timeit
+
+from correlatr.compact import compress_payload, dictionary_version, pack_values, unpack_values
+from correlatr.response import create_response
+from protos import server_pb2, shared_pb2
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the compact encoding against data points')
+    parser.add_argument('--columns', type=int, nargs='+', default=[10, 50, 200], help='numbers of columns to test')
+    parser.add_argument('--null-fraction', type=float, default=0.2, help='fraction of values that are null')
+    parser.add_argument('--repeat', type=int, default=2000, help='number of parses to time')
+    args = parser.parse_args()
+
+    print(f"{'columns':>8} {'encoding':>18} {'bytes':>8} {'parse us':>9}")
+    for column_count in args.columns:
+        columns = [f'Metric number {i} tracked daily' for i in range(column_count)]
+        values = [None if random.random() < args.null_fraction else random.uniform(0, 100) for _ in columns]
+
+        encodings = {
+            'data points': (data_point_response(columns, values).SerializeToString(), parse_data_points),
+            'compact': (compact_response(columns, values).SerializeToString(), parse_compact),
+        }
+        compressed, _ = compress_payload(encodings['data points'][0])
+        encodings['data points+deflate'] = (compressed, None)
+        compressed, _ = compress_payload(encodings['compact'][0])
+        encodings['compact+deflate'] = (compressed, None)
+
+        for name, (payload, parse) in encodings.items():
+            if parse is None:
+                print(f'{column_count:>8} {name:>18} {len(payload):>8} {"":>9}')
+                continue
+            seconds = timeit.timeit(lambda: parse(payload), number=args.repeat)
+            print(f'{column_count:>8} {name:>18} {len(payload):>8} {seconds / args.repeat * 1e6:>9.1f}')
+
+def data_point_response(columns, values):
+    """Creates a response the way get_data_for_date does without compact mode
+
+    Args:
+        columns ([str]): The column names
+        values ([float]): A value for each column, or None if it is null
+
+    Returns: The response message
+    """
+    response = create_response('Row already present in database for this date', False)
+    for column, value in zip(columns, values):
+        data_point = shared_pb2.DataPoint()
+        data_point.columnName = column
+        if value is None:
+            data_point.null = True
+        else:
+            data_point.value = value
+        response.dataPoints.append(data_point)
+    return response
+
+def compact_response(columns, values):
+    """Creates a response the way get_data_for_date does in compact mode
+
+    Args:
+        columns ([str]): The column names
+        values ([float]): A value for each column, or None if it is null
+
+    Returns: The response message
+    """
+    response = create_response('Row already present in database for this date', False)
+    response.compactData.dictionaryVersion = dictionary_version(columns)
+    response.compactData.columnIndexes.extend(range(len(columns)))
+    response.compactData.values, response.compactData.nullBitmap = pack_values(values)
+    return response
+
+def parse_data_points(payload):
+    """Parses a data point response into a dict of column name to value
+
+    Args:
+        payload (bytes): The serialized response
+    """
+    response = server_pb2.ServerMessage()
+    response.ParseFromString(payload)
+    return {point.columnName: None if point.null else point.value for point in response.dataPoints}
+
+def parse_compact(payload):
+    """Parses a compact response into a list of values in column dictionary order
+
+    Args:
+        payload (bytes): The serialized response
+    """
+    response = server_pb2.ServerMessage()
+    response.ParseFromString(payload)
+    return unpack_values(response.compactData.values, response.compactData.nullBitmap)
+
+if __name__ == "__main__":
+    main()
@@ -6,13 +6,15 @@ INSTALL_REQUIRES = [
     'protobuf',
     'psycopg2',
     'pandas',
+    'numpy',
     'seaborn'
 ]
 
 ENTRY_POINTS = {
     'console_scripts': [
         'CorrelatR=correlatr.scripts.start_server:main',
-        'compile_protos=correlatr.scripts.compile_protos:main'
+        'compile_protos=correlatr.scripts.compile_protos:main',
+        'rebuild_column_stats=correlatr.scripts.rebuild_column_stats:main'
     ]
 }
 
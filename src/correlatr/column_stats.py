@@ -0,0 +1,136 @@
+"""Summary statistics of a column that can be kept up to date one cell change at a time
+
+Statistics are stored as dicts keyed by the columns of the stats table. The mean and variance are
+maintained with Welford's algorithm, which stays numerically stable over long histories. The min
+and max are kept along with how many values equal them, so removing one of several equal values
+is still incremental. Removing the last value equal to the min or max, or the value at either end
+of the date range, makes them unknowable without a full scan, in which case the statistics are
+marked stale until they are rebuilt
+"""
+import math
+
+#Relative difference allowed between stored and rebuilt statistics when verifying them
+VERIFY_TOLERANCE = 1e-9
+
+def empty_stats():
+    """Creates the statistics of a column with no values
+
+    Returns: The statistics dict
+    """
+    return {'COUNT': 0, 'MEAN': 0.0, 'M2': 0.0, 'MIN': None, 'MIN_COUNT': 0, 'MAX': None, 'MAX_COUNT': 0,
+        'FIRST_DATE': None, 'LAST_DATE': None, 'LAST_VALUE': None, 'STALE': False}
+
+def compute_stats(date_values):
+    """Computes the statistics of a column from scratch
+
+    Args:
+        date_values: Iterable of (date, value) pairs, sorted by date, where value is not None
+
+    Returns: The statistics dict
+    """
+    stats = empty_stats()
+    for date, value in date_values:
+        add_value(stats, date, value)
+    return stats
+
+def apply_change(stats, date, old_value, new_value):
+    """Updates statistics in place for a single cell changing value
+
+    Args:
+        stats (dict): The statistics of the cell's column
+        date (int): The date of the cell
+        old_value (float): The cell's previous value, or None if it was not set
+        new_value (float): The cell's new value, or None if it is being cleared
+    """
+    if old_value is not None:
+        remove_value(stats, date, old_value, new_value is not None)
+    if new_value is not None:
+        add_value(stats, date, new_value)
+
+def add_value(stats, date, value):
+    """Updates statistics in place for a new value
+
+    Args:
+        stats (dict): The statistics of the value's column
+        date (int): The date of the value
+        value (float): The value
+    """
+    stats['COUNT'] += 1
+    delta = value - stats['MEAN']
+    stats['MEAN'] += delta / stats['COUNT']
+    stats['M2'] += delta * (value - stats['MEAN'])
+    if stats['MIN'] is None or value < stats['MIN']:
+        stats['MIN'], stats['MIN_COUNT'] = value, 1
+    elif value == stats['MIN']:
+        stats['MIN_COUNT'] += 1
+    if stats['MAX'] is None or value > stats['MAX']:
+        stats['MAX'], stats['MAX_COUNT'] = value, 1
+    elif value == stats['MAX']:
+        stats['MAX_COUNT'] += 1
+
+    if stats['FIRST_DATE'] is None or date < stats['FIRST_DATE']:
+        stats['FIRST_DATE'] = date
+    if stats['LAST_DATE'] is None or date >= stats['LAST_DATE']:
+        stats['LAST_DATE'] = date
+        stats['LAST_VALUE'] = value
+
+def remove_value(stats, date, value, replaced):
+    """Updates statistics in place for a value that is no longer present
+
+    Args:
+        stats (dict): The statistics of the value's column
+        date (int): The date of the value
+        value (float): The value
+        replaced (bool): Whether a new value is being added on the same date
+    """
+    if stats['COUNT'] <= 1:
+        stats.update(empty_stats())
+        return
+
+    old_mean = stats['MEAN']
+    stats['COUNT'] -= 1
+    stats['MEAN'] = old_mean - (value - old_mean) / stats['COUNT']
+    stats['M2'] = max(stats['M2'] - (value - old_mean) * (value - stats['MEAN']), 0.0)
+
+    if value == stats['MIN']:
+        stats['MIN_COUNT'] -= 1
+        if stats['MIN_COUNT'] <= 0:
+            stats['STALE'] = True
+    if value == stats['MAX']:
+        stats['MAX_COUNT'] -= 1
+        if stats['MAX_COUNT'] <= 0:
+            stats['STALE'] = True
+    if not replaced and date in (stats['FIRST_DATE'], stats['LAST_DATE']):
+        stats['STALE'] = True
+
+def stddev(stats):
+    """Gets the sample standard deviation from statistics
+
+    Args:
+        stats (dict): The statistics of a column
+
+    Returns: The standard deviation, or 0 if there are fewer than two values
+    """
+    if stats['COUNT'] < 2:
+        return 0.0
+    return math.sqrt(stats['M2'] / (stats['COUNT'] - 1))
+
+def stats_match(stored, rebuilt):
+    """Checks whether stored statistics agree with statistics rebuilt from scratch
+
+    Args:
+        stored (dict): The statistics read from the stats table
+        rebuilt (dict): The statistics from compute_stats
+
+    Returns: True if every statistic matches, within VERIFY_TOLERANCE for floating point ones
+    """
+    for key, expected in rebuilt.items():
+        actual = stored[key]
+        if key == 'STALE':
+            continue
+        if isinstance(expected, float) and actual is not None:
+            if not math.isclose(actual, expected, rel_tol=VERIFY_TOLERANCE, abs_tol=VERIFY_TOLERANCE):
+                return False
+        elif actual != expected:
+            return False
+    return True
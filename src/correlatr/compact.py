@@ -0,0 +1,99 @@
+"""Compact encoding of numeric rows and compression of message frames, to save bytes on slow links
+
+In compact mode, rows refer to columns by their index in the column dictionary returned by a
+columnsRequest, instead of repeating every column name. Values are packed little endian doubles,
+with a bitmap marking which of them are null
+"""
+import struct
+import zlib
+
+#Responses smaller than this are not worth compressing
+COMPRESSION_THRESHOLD = 1024
+#Set in the length prefix of a frame whose payload is deflate compressed
+COMPRESSED_FLAG = 1 << 31
+
+def dictionary_version(columns):
+    """Gets a version number for a column dictionary, which changes whenever the columns change
+
+    Args:
+        columns ([str]): The column names, in dictionary order
+
+    Returns: The version as an unsigned 32 bit int
+    """
+    return zlib.crc32('\0'.join(columns).encode('utf-8'))
+
+def pack_values(values):
+    """Packs a list of values into doubles and a null bitmap
+
+    Args:
+        values ([float]): The values to pack. None marks a null value
+
+    Returns: A tuple of (packed values, null bitmap) as bytes. Bit i of the bitmap is set if values[i] is null
+    """
+    bitmap = bytearray((len(values) + 7) // 8)
+    doubles = []
+    for i, value in enumerate(values):
+        if value is None:
+            bitmap[i // 8] |= 1 << (i % 8)
+            doubles.append(0.0)
+        else:
+            doubles.append(value)
+    return struct.pack(f'<{len(doubles)}d', *doubles), bytes(bitmap)
+
+def unpack_values(packed, bitmap):
+    """Unpacks values that were packed with pack_values
+
+    Args:
+        packed (bytes): The packed doubles
+        bitmap (bytes): The null bitmap
+
+    Returns: The list of values, with None for null values
+
+    Raises: ValueError if packed is not whole doubles or bitmap is the wrong length
+    """
+    if len(packed) % 8 != 0:
+        raise ValueError(f"{len(packed)} bytes of values is not a whole number of doubles")
+    count = len(packed) // 8
+    if len(bitmap) != (count + 7) // 8:
+        raise ValueError(f"Null bitmap has {len(bitmap)} bytes, but {count} values need {(count + 7) // 8}")
+    doubles = struct.unpack(f'<{count}d', packed)
+    return [None if bitmap[i // 8] & (1 << (i % 8)) else doubles[i] for i in range(count)]
+
+def compress_payload(payload):
+    """Deflate compresses a payload if it is large enough to be worth it
+
+    Args:
+        payload (bytes): The serialized message
+
+    Returns: A tuple of (payload, compressed), where compressed says whether payload was compressed
+    """
+    if len(payload) < COMPRESSION_THRESHOLD:
+        return payload, False
+    compressed = zlib.compress(payload)
+    if len(compressed) >= len(payload):
+        return payload, False
+    return compressed, True
+
+def frame_header(length, compressed):
+    """Creates the 4 byte length prefix that is sent before every message
+
+    Args:
+        length (int): Number of bytes in the payload
+        compressed (bool): Whether the payload is compressed
+
+    Returns: The header as bytes
+    """
+    if compressed:
+        length |= COMPRESSED_FLAG
+    return length.to_bytes(4, byteorder="big")
+
+def parse_frame_header(header):
+    """Reads a 4 byte length prefix created by frame_header
+
+    Args:
+        header (bytes): The length prefix
+
+    Returns: A tuple of (length, compressed)
+    """
+    value = int.from_bytes(header, "big")
+    return value & ~COMPRESSED_FLAG, bool(value & COMPRESSED_FLAG)
@@ -0,0 +1,180 @@
+"""Finds the strongest correlations between every pair of columns in the user data table"""
+import math
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+SECONDS_PER_DAY = 86400
+BLOCK_SIZE = 64
+#The matrix products already run on several BLAS threads, so only a few blocks are worth running at once
+MAX_WORKERS = 4
+SIGNIFICANCE_LEVEL = 0.05
+
+Correlation = namedtuple('Correlation', ['column1', 'column2', 'lag', 'r', 'n', 'p_value', 'adjusted_p_value'])
+
+def find_top_correlations(dates, columns, values, top_k, max_lag=0, min_samples=4, workers=None):
+    """Scans every pair of columns, optionally with a lag, and returns the strongest correlations
+
+    Correlations that are significant after Benjamini-Hochberg correction are ranked first,
+    then everything is ordered by the absolute value of r
+
+    Args:
+        dates (numpy.ndarray): Sorted dates of every row, in seconds
+        columns ([str]): Names of the columns of values
+        values (numpy.ndarray): Matrix with one row per date and NaN for unset cells
+        top_k (int): Maximum number of correlations to return
+        max_lag (int): Largest lag to test, in days. column2 is shifted forward by lag days
+        min_samples (int): Pairs with fewer rows where both columns are set are ignored
+        workers (int): Number of threads to use. Defaults to the number of cores, up to MAX_WORKERS
+
+    Returns: A list of at most top_k Correlations
+    """
+    candidates = []
+    for lag in range(max_lag + 1):
+        r, n = pairwise_correlations(values, _lag_values(dates, values, lag), workers)
+        if lag == 0:
+            #A lag of zero is symmetric, so only look at each pair once
+            valid = numpy.triu(numpy.ones(r.shape, dtype=bool), k=1)
+        else:
+            valid = ~numpy.eye(r.shape[0], r.shape[1], dtype=bool)
+        valid &= (n >= min_samples) & ~numpy.isnan(r)
+
+        for i, j in zip(*numpy.nonzero(valid)):
+            candidates.append((columns[i], columns[j], lag, float(r[i, j]), int(n[i, j])))
+
+    p_values = [correlation_p_value(r, n) for _, _, _, r, n in candidates]
+    adjusted_p_values = benjamini_hochberg(p_values)
+
+    correlations = [Correlation(*candidate, p_value, adjusted_p_value)
+        for candidate, p_value, adjusted_p_value in zip(candidates, p_values, adjusted_p_values)]
+    correlations.sort(key=lambda c: (c.adjusted_p_value > SIGNIFICANCE_LEVEL, -abs(c.r)))
+    return correlations[:top_k]
+
+def pairwise_correlations(x, y, workers=None, block_size=BLOCK_SIZE):
+    """Computes the Pearson correlation of every column of x against every column of y
+
+    Each pair only uses the rows where both columns are set. The work is split into
+    blocks of columns of x, which are computed in parallel
+
+    Args:
+        x (numpy.ndarray): Matrix of values with NaN for unset cells
+        y (numpy.ndarray): Matrix of values with the same number of rows as x
+        workers (int): Number of threads to use. Defaults to the number of cores, up to MAX_WORKERS
+        block_size (int): Number of columns of x in each block
+
+    Returns: A tuple of (r, n) matrices, indexed by [x column, y column]
+    """
+    x_mask = ~numpy.isnan(x)
+    y_mask = ~numpy.isnan(y)
+    #Centering first keeps the sums of squares small, which avoids catastrophic cancellation
+    x_centered = numpy.where(x_mask, x - _column_means(x, x_mask), 0.0)
+    y_centered = numpy.where(y_mask, y - _column_means(y, y_mask), 0.0)
+    x_mask = x_mask.astype(float)
+    y_mask = y_mask.astype(float)
+    y_squared = y_centered * y_centered
+
+    r = numpy.full((x.shape[1], y.shape[1]), numpy.nan)
+    n = numpy.zeros((x.shape[1], y.shape[1]), dtype=int)
+
+    def compute_block(start):
+        stop = min(start + block_size, x.shape[1])
+        block_mask = x_mask[:, start:stop]
+        block = x_centered[:, start:stop]
+
+        count = block_mask.T @ y_mask
+        sum_x = block.T @ y_mask
+        sum_y = block_mask.T @ y_centered
+        sum_xx = (block * block).T @ y_mask
+        sum_yy = block_mask.T @ y_squared
+        sum_xy = block.T @ y_centered
+
+        covariance = count * sum_xy - sum_x * sum_y
+        variance = (count * sum_xx - sum_x * sum_x) * (count * sum_yy - sum_y * sum_y)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            block_r = numpy.where(variance > 0, covariance / numpy.sqrt(variance), numpy.nan)
+
+        r[start:stop] = numpy.clip(block_r, -1.0, 1.0)
+        n[start:stop] = numpy.rint(count).astype(int)
+
+    starts = range(0, x.shape[1], block_size)
+    if len(starts) > 1:
+        with ThreadPoolExecutor(max_workers=workers or min(os.cpu_count() or 1, MAX_WORKERS)) as executor:
+            list(executor.map(compute_block, starts))
+    else:
+        for start in starts:
+            compute_block(start)
+
+    return r, n
+
+def correlation_p_value(r, n):
+    """Two sided p-value of a Pearson correlation, using the Fisher z-transformation
+
+    Args:
+        r (float): The correlation coefficient
+        n (int): The number of samples used to compute r
+
+    Returns: The p-value, or 1.0 if there are too few samples
+    """
+    if n <= 3:
+        return 1.0
+    r = min(max(r, -1.0 + 1e-15), 1.0 - 1e-15)
+    z = math.atanh(r) * math.sqrt(n - 3)
+    return math.erfc(abs(z) / math.sqrt(2))
+
+def benjamini_hochberg(p_values):
+    """Adjusts p-values for multiple comparisons, controlling the false discovery rate
+
+    Args:
+        p_values ([float]): The unadjusted p-values
+
+    Returns: The adjusted p-values, in the same order as p_values
+    """
+    count = len(p_values)
+    adjusted = [1.0] * count
+    running_min = 1.0
+    order = sorted(range(count), key=lambda i: p_values[i], reverse=True)
+    for rank_from_end, i in enumerate(order):
+        rank = count - rank_from_end
+        running_min = min(running_min, p_values[i] * count / rank)
+        adjusted[i] = running_min
+    return adjusted
+
+def _lag_values(dates, values, lag):
+    """Shifts values so that each row holds the values from lag days later
+
+    Rows are matched by the nearest whole day rather than the exact second, so that days
+    that are an hour longer or shorter around a daylight saving change still line up
+
+    Args:
+        dates (numpy.ndarray): Sorted dates of every row, in seconds
+        values (numpy.ndarray): Matrix with one row per date
+        lag (int): Number of days to shift by
+
+    Returns: The shifted matrix, with NaN where no row exists lag days later
+    """
+    if lag == 0:
+        return values
+    days = numpy.rint(dates / SECONDS_PER_DAY)
+    targets = days + lag
+    indexes = numpy.searchsorted(days, targets)
+    found = indexes < len(days)
+    found[found] = days[indexes[found]] == targets[found]
+
+    lagged = numpy.full(values.shape, numpy.nan)
+    lagged[found] = values[indexes[found]]
+    return lagged
+
+def _column_means(values, mask):
+    """Mean of each column, ignoring unset cells
+
+    Args:
+        values (numpy.ndarray): Matrix with NaN for unset cells
+        mask (numpy.ndarray): Boolean matrix that is True where values are set
+
+    Returns: A row vector of means, with 0 for columns that are never set
+    """
+    counts = mask.sum(axis=0)
+    sums = numpy.where(mask, values, 0.0).sum(axis=0)
+    return numpy.divide(sums, counts, out=numpy.zeros(values.shape[1]), where=counts > 0)
@@ -1,37 +1,126 @@
 from base64 import b64encode, b64decode
-
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import itertools
+import random
+import threading
+import time
+import traceback
+
+import numpy
 import sqlalchemy
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+from . import column_stats
+from .compact import dictionary_version, pack_values
 from .response import create_response
 from protos import shared_pb2
 
 #Create a sessionmaker singleton
 _Session = sessionmaker()
 
+ColumnPairSums = namedtuple('ColumnPairSums', ['count', 'sum_x', 'sum_y', 'sum_xx', 'sum_xy', 'min_x', 'max_x', 'min_y', 'max_y'])
+
+#Engines are shared by every DBConnection to the same url, so that their connection pools are reused
+_engines = {}
+_engines_lock = threading.Lock()
+
+#Used to spread reads across the replicas
+_reader_counter = itertools.count()
+
+#After a client writes, its reads go to the writer for this many seconds so that it sees its own
+#writes even while the replicas are lagging behind
+STICKY_SECONDS = 5.0
+MAX_TRACKED_WRITERS = 1024
+#The time of the last write by each (url, table_name, client_id)
+_last_writes = {}
+_last_writes_lock = threading.Lock()
+
+#Counts the changes made to each (url, table_name) by this process, so that derived results can be cached
+_data_versions = {}
+_data_versions_lock = threading.Lock()
+
+#Every column change made by this process runs on this one thread, in the order they were requested,
+#so concurrent column edits from several clients cannot conflict with each other
+_schema_change_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='schema-change')
+
+#Stale column statistics are rebuilt one column at a time on this thread, so reading them never waits for a scan
+_stats_rebuild_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='stats-rebuild')
+#The (url, stats table name, safe column name) of every rebuild that is queued or running
+_pending_stats_rebuilds = set()
+_pending_stats_rebuilds_lock = threading.Lock()
+
+#How long an ALTER TABLE may wait for its lock before giving up, so it never holds up other queries for long
+SCHEMA_LOCK_TIMEOUT_MS = 2000
+SCHEMA_CHANGE_ATTEMPTS = 5
+#Seconds to wait before the first retry. This doubles after every attempt
+SCHEMA_CHANGE_BACKOFF = 0.2
+#Longest a column change can take when every attempt times out, including the most jitter on each backoff
+SCHEMA_CHANGE_MAX_SECONDS = (SCHEMA_CHANGE_ATTEMPTS * SCHEMA_LOCK_TIMEOUT_MS / 1000
+    + sum(SCHEMA_CHANGE_BACKOFF * 2 ** attempt * 1.5 for attempt in range(SCHEMA_CHANGE_ATTEMPTS - 1)))
+
+def _serialized_schema_change(method):
+    """Decorates a DBConnection method so that it runs on the schema change thread"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return _schema_change_executor.submit(method, *args, **kwargs).result()
+    return wrapper
+
 class DBConnection:
     TABLE_NAME = 'user_data'
+    #Appended to the table name to get the name of the table holding its column statistics
+    STATS_TABLE_SUFFIX = '_stats'
 
-    def __init__(self, url, table_name):
+    def __init__(self, url, table_name, reader_urls=None, client_id=None):
         """A class that handles operations that interact with
         the database
 
+        Each connection reads from a single database, so that the reads it makes agree with each
+        other. Connections are spread across the reader databases, except for those of a client
+        that wrote within the last STICKY_SECONDS, and connections that have written, which read
+        from the writer
+
         Args:
-            url (str): The database url to connect to
+            url (str): The database url to connect to. All writes go here
             table_name (str): The name of the table to operate on
+            reader_urls ([str]): Urls of read replicas of the database. Defaults to reading from url
+            client_id (str): Identifies the client this connection is acting for
         """
-        self._engine = sqlalchemy.create_engine(url)
+        self._engine = _get_engine(url)
+        self._reader_engines = [_get_engine(reader_url) for reader_url in reader_urls or []]
+        #Picked by _read_engine on the first read
+        self._chosen_read_engine = None
         _Session.configure(bind=self._engine)
+        self.url = url
         self.table_name = table_name
+        self.stats_table_name = table_name + self.STATS_TABLE_SUFFIX
+        self.client_id = client_id
         self._session = _Session()
 
-        #This will create the new table if and only if it does not exist alreadu
+        #This will create the new tables if and only if they do not exist alreadu
         Base = declarative_base()
         class UserTable(Base):
             __tablename__ = table_name
 
             DATE = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+
+        class ColumnStatsTable(Base):
+            __tablename__ = self.stats_table_name
+
+            COLUMN_NAME = sqlalchemy.Column(sqlalchemy.String, primary_key=True)
+            COUNT = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            MEAN = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+            M2 = sqlalchemy.Column(sqlalchemy.Float, nullable=False)
+            MIN = sqlalchemy.Column(sqlalchemy.Float)
+            MIN_COUNT = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            MAX = sqlalchemy.Column(sqlalchemy.Float)
+            MAX_COUNT = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+            FIRST_DATE = sqlalchemy.Column(sqlalchemy.Integer)
+            LAST_DATE = sqlalchemy.Column(sqlalchemy.Integer)
+            LAST_VALUE = sqlalchemy.Column(sqlalchemy.Float)
+            STALE = sqlalchemy.Column(sqlalchemy.Boolean, nullable=False)
         Base.metadata.create_all(self._engine)
 
     def set_data(self, date, data_points):
@@ -44,35 +133,43 @@ class DBConnection:
         Returns: The response message to send to the client 
         """
         table = self._get_table()
-        data = self._session.query(table).filter_by(DATE=date).one_or_none()
-        self._session.commit()
 
         #Make column names safe
         safe_points = {}
         for key, value in data_points.items():
             safe_points[get_safe_column_name(key)] = value
-        
-        if data is None:
-            ins = table.insert().values(DATE = date, **safe_points)
-            self._engine.connect().execute(ins)
-            return create_response('Inserting a new row into the database', False)
-        else:
-            upd = table.update().where(table.c.DATE == date).values(**safe_points)
-            self._engine.connect().execute(upd)
-
-            return create_response('Updating a row in the database', False)
 
-    def get_data_for_date(self, date):
+        #The row and the column statistics are updated in one transaction so they cannot disagree
+        with self._engine.begin() as connection:
+            data = connection.execute(table.select().where(table.c.DATE == date).with_for_update()).first()
+            if data is None:
+                ins = table.insert().values(DATE = date, **safe_points)
+                connection.execute(ins)
+                message = 'Inserting a new row into the database'
+            else:
+                upd = table.update().where(table.c.DATE == date).values(**safe_points)
+                connection.execute(upd)
+                message = 'Updating a row in the database'
+            self._update_column_stats(connection, date, data, safe_points)
+
+        self._record_write()
+        return create_response(message, False)
+
+    def get_data_for_date(self, date, compact=False):
         """Get all of the data associated with a specific date as a list of tuples
 
         Args:
             date (int): Date to get data from
+            compact (bool): Whether to send the data as a compact row instead of data points
         
         Returns: A list of tuples describing (column_name, data)
         """
-        table = self._get_table()
-        data = self._session.query(table).filter_by(DATE=date).one_or_none()
-        self._session.commit()
+        if compact:
+            return self._get_compact_data_for_date(date)
+
+        session, table = self._reader()
+        data = session.query(table).filter_by(DATE=date).one_or_none()
+        session.close()
         if data is None:
             response = create_response('No row present in database for this date', False)
             columns = self.get_all_columns()
@@ -98,6 +195,33 @@ class DBConnection:
                     
         return response
 
+    def _get_compact_data_for_date(self, date):
+        """Get all of the data associated with a specific date as a compact row, which holds
+        a value for every column in the column dictionary
+
+        Args:
+            date (int): Date to get data from
+
+        Returns: The response message to send to the client
+        """
+        session, table = self._reader()
+        safe_columns = [column.name for column in table.c if column.name != "DATE"]
+        data = session.query(table).filter_by(DATE=date).one_or_none()
+        session.close()
+        if data is None:
+            response = create_response('No row present in database for this date', False)
+            values = [None] * len(safe_columns)
+        else:
+            data = data._asdict()
+            response = create_response('Row already present in database for this date', False)
+            values = [data[column] for column in safe_columns]
+
+        columns = [get_actual_column_name(column) for column in safe_columns]
+        response.compactData.dictionaryVersion = dictionary_version(columns)
+        response.compactData.columnIndexes.extend(range(len(columns)))
+        response.compactData.values, response.compactData.nullBitmap = pack_values(values)
+        return response
+
     def get_data_in_columns(self, column1, column2):
         """Gets all the values of two columns, stored as a list of tuples where row is
         date | column1 | column2
@@ -113,9 +237,9 @@ class DBConnection:
         safe_column1 = get_safe_column_name(column1)
         safe_column2 = get_safe_column_name(column2)
 
-        table = self._get_table()
-        query_results = self._session.query(table.c[safe_column1], table.c[safe_column2]).all()
-        self._session.commit()
+        session, table = self._reader()
+        query_results = session.query(table.c[safe_column1], table.c[safe_column2]).all()
+        session.close()
 
         trimmed_results = []
         for result in query_results:
@@ -124,12 +248,104 @@ class DBConnection:
 
         return trimmed_results
 
-    def get_all_columns(self):
+    def get_column_pair_sums(self, column1, column2):
+        """Gets the count, sums and bounds of two columns over the rows where both are set,
+        computed by the database so that no rows are transferred
+
+        Args:
+            column1: Column to use as x
+            column2: Column to use as y
+
+        Returns: A ColumnPairSums. The sums and bounds are None if no rows have both columns set
+        """
+        session, table = self._reader()
+        x = table.c[get_safe_column_name(column1)]
+        y = table.c[get_safe_column_name(column2)]
+        func = sqlalchemy.func
+        query_result = session.query(func.count(), func.sum(x), func.sum(y), func.sum(x * x), func.sum(x * y),
+            func.min(x), func.max(x), func.min(y), func.max(y)).filter(x.isnot(None), y.isnot(None)).one()
+        session.close()
+
+        count = query_result[0]
+        return ColumnPairSums(count, *(float(value) if value is not None else None for value in query_result[1:]))
+
+    def get_binned_data_in_columns(self, column1, column2, bins, sums):
+        """Counts the rows where both columns are set in each cell of a bins x bins grid, computed by the database
+
+        Args:
+            column1: Column to use as x
+            column2: Column to use as y
+            bins (int): Number of bins along each axis
+            sums (ColumnPairSums): The bounds of the columns, from get_column_pair_sums
+
+        Returns: A tuple of (x bin edges, y bin edges, counts) where counts is indexed by [x bin, y bin]
+        """
+        session, table = self._reader()
+        x = table.c[get_safe_column_name(column1)]
+        y = table.c[get_safe_column_name(column2)]
+        x_edges = numpy.linspace(sums.min_x, sums.max_x if sums.max_x > sums.min_x else sums.min_x + 1, bins + 1)
+        y_edges = numpy.linspace(sums.min_y, sums.max_y if sums.max_y > sums.min_y else sums.min_y + 1, bins + 1)
+
+        def bin_index(column, edges):
+            scaled = (column - float(edges[0])) * float(bins / (edges[-1] - edges[0]))
+            #Rows written after the bounds were read can fall outside them, so clamp to the edge bins.
+            #This has to happen before casting, as values far outside the bounds do not fit in an integer
+            scaled = sqlalchemy.case([(scaled >= bins, bins - 1), (scaled < 0, 0)], else_=scaled)
+            #postgresql rounds when casting to an integer, so it has to floor first
+            if session.bind.dialect.name == 'postgresql':
+                scaled = sqlalchemy.func.floor(scaled)
+            return sqlalchemy.cast(scaled, sqlalchemy.Integer)
+
+        x_bin = bin_index(x, x_edges).label('x_bin')
+        y_bin = bin_index(y, y_edges).label('y_bin')
+        query_results = session.query(x_bin, y_bin, sqlalchemy.func.count()) \
+            .filter(x.isnot(None), y.isnot(None)).group_by(x_bin, y_bin).all()
+        session.close()
+
+        counts = numpy.zeros((bins, bins), dtype=int)
+        for x_index, y_index, count in query_results:
+            counts[x_index, y_index] = count
+        return x_edges, y_edges, counts
+
+    def get_all_data(self):
+        """Gets every row of the table with a single query, sorted by date
+
+        Returns: A tuple of (dates, columns, values), where dates is an array of the date of each row,
+            columns is the list of column names and values is a matrix with one row per date
+            and NaN for unset cells
+        """
+        session, table = self._reader()
+        value_columns = [column for column in table.c if column.name != "DATE"]
+        query_results = session.query(table.c.DATE, *value_columns).order_by(table.c.DATE).all()
+        session.close()
+
+        dates = numpy.array([result[0] for result in query_results], dtype=float)
+        values = numpy.array([result[1:] for result in query_results], dtype=float)
+        values = values.reshape((len(query_results), len(value_columns)))
+        columns = [get_actual_column_name(column.name) for column in value_columns]
+        return dates, columns, values
+
+    @property
+    def data_version(self):
+        """A number that changes whenever this process changes the table's data or columns"""
+        with _data_versions_lock:
+            return _data_versions.get((self.url, self.table_name), 0)
+
+    @property
+    def reads_from_writer(self):
+        """Whether this connection reads from the writer, and so sees every change counted by data_version"""
+        return self._read_engine() is self._engine
+
+    def get_all_columns(self, from_writer=False):
         """Get the names of all the columns in the table
 
+        Args:
+            from_writer (bool): Whether to read them from the writer, where writes will be made,
+                rather than a replica that may not have caught up with column changes yet
+
         Returns: The list of column names
         """
-        table = self._get_table()
+        table = self._get_table(self._engine if from_writer else self._read_engine())
         columns = []
         for column in table.c:
             if column.name != "DATE":
@@ -137,6 +353,7 @@ class DBConnection:
 
         return columns
 
+    @_serialized_schema_change
     def add_column(self, column_name):
         """Adds a column to the table
 
@@ -154,9 +371,18 @@ class DBConnection:
         elif len(safe_column_name) > 63:
             return create_response(f"Column name {column_name} is too long!", True)
         else:
-            self._engine.connect().execute(f'ALTER TABLE {self.table_name} ADD COLUMN "{safe_column_name}" float')
-            return create_response(f"{column_name} has been added", False)
-
+            stats_table = self._get_stats_table()
+            def add_stats(connection):
+                connection.execute(stats_table.delete().where(stats_table.c.COLUMN_NAME == safe_column_name))
+                connection.execute(stats_table.insert().values(COLUMN_NAME=safe_column_name, **column_stats.empty_stats()))
+
+            attempts = self._execute_schema_change(f'ALTER TABLE {self.table_name} ADD COLUMN "{safe_column_name}" float', add_stats)
+            if not attempts:
+                return create_response(f"Timed out adding {column_name}, the table is busy", True)
+            self._record_write()
+            return create_response(f"{column_name} has been added{_retry_note(attempts)}", False)
+
+    @_serialized_schema_change
     def remove_column(self, column_name):
         """Removes a column from the database table
 
@@ -170,9 +396,17 @@ class DBConnection:
         if safe_column_name not in table.c:
             return create_response(f"{column_name} is not in the table", True)
         else:
-            self._engine.connect().execute(f'ALTER TABLE {self.table_name} DROP COLUMN "{safe_column_name}"')
-            return create_response(f"{column_name} has been removed", False)
+            stats_table = self._get_stats_table()
+            def remove_stats(connection):
+                connection.execute(stats_table.delete().where(stats_table.c.COLUMN_NAME == safe_column_name))
+
+            attempts = self._execute_schema_change(f'ALTER TABLE {self.table_name} DROP COLUMN "{safe_column_name}"', remove_stats)
+            if not attempts:
+                return create_response(f"Timed out removing {column_name}, the table is busy", True)
+            self._record_write()
+            return create_response(f"{column_name} has been removed{_retry_note(attempts)}", False)
 
+    @_serialized_schema_change
     def rename_column(self, old_column_name, new_column_name):
         """Rename a column in the database table
 
@@ -193,16 +427,270 @@ class DBConnection:
         elif safe_new_column_name == safe_old_column_name:
             return create_response(f'{old_column_name} is the same as {new_column_name}', True)
         else:
-            self._engine.connect().execute(f'ALTER TABLE {self.table_name} RENAME COLUMN "{safe_old_column_name}" TO "{safe_new_column_name}"')
-            return create_response(f"{old_column_name} has been renamed to {new_column_name}", False)
+            stats_table = self._get_stats_table()
+            def rename_stats(connection):
+                connection.execute(stats_table.delete().where(stats_table.c.COLUMN_NAME == safe_new_column_name))
+                connection.execute(stats_table.update().where(stats_table.c.COLUMN_NAME == safe_old_column_name)
+                    .values(COLUMN_NAME=safe_new_column_name))
+
+            attempts = self._execute_schema_change(
+                f'ALTER TABLE {self.table_name} RENAME COLUMN "{safe_old_column_name}" TO "{safe_new_column_name}"', rename_stats)
+            if not attempts:
+                return create_response(f"Timed out renaming {old_column_name}, the table is busy", True)
+            self._record_write()
+            return create_response(f"{old_column_name} has been renamed to {new_column_name}{_retry_note(attempts)}", False)
+
+    def get_column_stats(self):
+        """Gets the summary statistics of every column from the stats table, without reading the
+        user data. Columns whose statistics are missing or stale are rebuilt in the background,
+        meanwhile stale statistics are returned as they are and missing ones are left out
+
+        Returns: A list of (column name, statistics dict) tuples, in table order
+        """
+        session, table = self._reader()
+        stats_table = self._get_stats_table(session.bind)
+        rows = session.query(stats_table).all()
+        session.close()
+
+        safe_columns = [column.name for column in table.c if column.name != "DATE"]
+        stats_by_column = {row.COLUMN_NAME: row._asdict() for row in rows}
+        outdated = [column for column in safe_columns
+            if column not in stats_by_column or stats_by_column[column]['STALE']]
+        if outdated:
+            self._rebuild_column_stats_later(outdated)
+
+        return [(get_actual_column_name(column), stats_by_column[column])
+            for column in safe_columns if column in stats_by_column]
+
+    def rebuild_column_stats(self, safe_columns=None):
+        """Recomputes column statistics from the user data and stores them
+
+        Args:
+            safe_columns ([str]): Safe names of the columns to rebuild. Defaults to every column
 
-    def _get_table(self):
+        Returns: A dict of safe column name to the rebuilt statistics dict
+        """
+        table = self._get_table()
+        stats_table = self._get_stats_table()
+        if safe_columns is None:
+            safe_columns = [column.name for column in table.c if column.name != "DATE"]
+
+        rebuilt = {}
+        for column in safe_columns:
+            #The row has to exist before the rebuild locks it, or there would be nothing for set_data to wait on
+            try:
+                with self._engine.begin() as connection:
+                    exists = connection.execute(stats_table.select().where(stats_table.c.COLUMN_NAME == column)).first()
+                    if exists is None:
+                        connection.execute(stats_table.insert().values(COLUMN_NAME=column, **column_stats.empty_stats()))
+            except sqlalchemy.exc.IntegrityError:
+                #Another rebuild or add_column inserted it first
+                pass
+
+            with self._engine.begin() as connection:
+                #Hold the stats row while reading the column. A set_data whose row change this scan cannot see
+                #waits on the lock, then reads the rebuilt row and applies its change on top. The row must be
+                #updated in place for that, as a waiting writer would skip a row that was deleted and reinserted
+                connection.execute(stats_table.select().where(stats_table.c.COLUMN_NAME == column).with_for_update())
+                values = connection.execute(sqlalchemy.select([table.c.DATE, table.c[column]])
+                    .where(table.c[column].isnot(None)).order_by(table.c.DATE))
+                stats = column_stats.compute_stats(values)
+                connection.execute(stats_table.update().where(stats_table.c.COLUMN_NAME == column).values(**stats))
+            rebuilt[column] = stats
+        return rebuilt
+
+    def verify_column_stats(self):
+        """Checks the stored statistics of every column against statistics computed from the user data
+
+        Returns: The names of the columns whose statistics are missing or wrong
+        """
+        table = self._get_table()
+        stats_table = self._get_stats_table()
+        with self._engine.connect() as connection:
+            stored = {row.COLUMN_NAME: dict(row) for row in connection.execute(stats_table.select())}
+            mismatched = []
+            for column in table.c:
+                if column.name == "DATE":
+                    continue
+                values = connection.execute(sqlalchemy.select([table.c.DATE, column])
+                    .where(column.isnot(None)).order_by(table.c.DATE))
+                expected = column_stats.compute_stats(values)
+                if column.name not in stored or not column_stats.stats_match(stored[column.name], expected):
+                    mismatched.append(get_actual_column_name(column.name))
+        return mismatched
+
+    def _rebuild_column_stats_later(self, safe_columns):
+        """Queues columns to have their statistics rebuilt on the stats rebuild thread, unless they already are
+
+        Args:
+            safe_columns ([str]): Safe names of the columns to rebuild
+        """
+        with _pending_stats_rebuilds_lock:
+            keys = [(self.url, self.stats_table_name, column) for column in safe_columns]
+            keys = [key for key in keys if key not in _pending_stats_rebuilds]
+            _pending_stats_rebuilds.update(keys)
+        if keys:
+            _stats_rebuild_executor.submit(self._rebuild_column_stats_in_background, keys)
+
+    def _rebuild_column_stats_in_background(self, keys):
+        """Rebuilds the statistics of columns queued by _rebuild_column_stats_later
+
+        Args:
+            keys ([tuple]): The keys of the columns in _pending_stats_rebuilds
+        """
+        try:
+            self.rebuild_column_stats([column for _, _, column in keys])
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            with _pending_stats_rebuilds_lock:
+                _pending_stats_rebuilds.difference_update(keys)
+
+    def _update_column_stats(self, connection, date, old_row, safe_points):
+        """Applies the changes made to a row to the statistics of its columns
+
+        Args:
+            connection (sqlalchemy.engine.Connection): The connection the row was changed in
+            date (int): The date of the row
+            old_row: The row before it was changed, or None if it is new
+            safe_points (dict): (Safe column name, new value) pairs that were stored in the row
+        """
+        stats_table = self._get_stats_table()
+        rows = connection.execute(stats_table.select()
+            .where(stats_table.c.COLUMN_NAME.in_(list(safe_points))).with_for_update())
+        for row in rows.fetchall():
+            stats = dict(row)
+            column = stats.pop('COLUMN_NAME')
+            old_value = old_row[column] if old_row is not None else None
+            new_value = safe_points[column]
+            if old_value == new_value:
+                continue
+            column_stats.apply_change(stats, date, old_value, new_value)
+            connection.execute(stats_table.update().where(stats_table.c.COLUMN_NAME == column).values(**stats))
+
+    def _execute_schema_change(self, statement, after=None):
+        """Executes a schema change statement in its own transaction. If it cannot get its lock within
+        SCHEMA_LOCK_TIMEOUT_MS, it is retried with exponential backoff
+
+        Args:
+            statement (str): The ALTER TABLE statement to execute
+            after (callable): Called with the connection to make further changes in the same transaction
+
+        Returns: The number of attempts it took, or 0 if every attempt timed out
+        """
+        for attempt in range(1, SCHEMA_CHANGE_ATTEMPTS + 1):
+            try:
+                with self._engine.begin() as connection:
+                    if self._engine.dialect.name == 'postgresql':
+                        connection.execute(f"SET LOCAL lock_timeout = '{SCHEMA_LOCK_TIMEOUT_MS}ms'")
+                    connection.execute(statement)
+                    if after is not None:
+                        after(connection)
+                return attempt
+            except sqlalchemy.exc.OperationalError as error:
+                if not _is_lock_timeout(error):
+                    raise
+                print(f"Schema change attempt {attempt} timed out waiting for a lock")
+                if attempt < SCHEMA_CHANGE_ATTEMPTS:
+                    time.sleep(SCHEMA_CHANGE_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+        return 0
+
+    def _record_write(self):
+        """Marks the table as changed by this connection's client, so that its reads go to the writer for a while"""
+        self._bump_data_version()
+        self._chosen_read_engine = self._engine
+        if self.client_id is not None:
+            now = time.monotonic()
+            with _last_writes_lock:
+                if len(_last_writes) >= MAX_TRACKED_WRITERS:
+                    for key, last_write in list(_last_writes.items()):
+                        if now - last_write > STICKY_SECONDS:
+                            del _last_writes[key]
+                _last_writes[(self.url, self.table_name, self.client_id)] = now
+
+    def _reader(self):
+        """Creates a session and loads the table for a read-only operation
+
+        Returns: A tuple of (session, table), bound to the database picked by _read_engine
+        """
+        engine = self._read_engine()
+        return _Session(bind=engine), self._get_table(engine)
+
+    def _read_engine(self):
+        """Picks the database to run read-only operations on. The first pick is kept for the life of the connection
+
+        Returns: The writer if there are no readers or this client wrote recently, otherwise the next reader
+        """
+        if self._chosen_read_engine is None:
+            with _last_writes_lock:
+                last_write = _last_writes.get((self.url, self.table_name, self.client_id))
+            if not self._reader_engines or (last_write is not None and time.monotonic() - last_write <= STICKY_SECONDS):
+                self._chosen_read_engine = self._engine
+            else:
+                self._chosen_read_engine = self._reader_engines[next(_reader_counter) % len(self._reader_engines)]
+        return self._chosen_read_engine
+
+    def _bump_data_version(self):
+        """Marks the table's data as changed, invalidating anything cached from it"""
+        with _data_versions_lock:
+            key = (self.url, self.table_name)
+            _data_versions[key] = _data_versions.get(key, 0) + 1
+
+    def _get_table(self, engine=None, table_name=None):
         """Loads the 'table_name' database table
 
+        Args:
+            engine (sqlalchemy.engine.Engine): The database to load it from. Defaults to the writer
+            table_name (str): The table to load instead of 'table_name'
+
         Returns: SqlAlchemy Table reflected from 'table_name'
         """
         metadata = sqlalchemy.MetaData()
-        return sqlalchemy.Table(self.table_name, metadata, autoload=True, autoload_with=self._engine)
+        return sqlalchemy.Table(table_name or self.table_name, metadata, autoload=True, autoload_with=engine or self._engine)
+
+    def _get_stats_table(self, engine=None):
+        """Loads the table holding the column statistics
+
+        Args:
+            engine (sqlalchemy.engine.Engine): The database to load it from. Defaults to the writer
+
+        Returns: SqlAlchemy Table reflected from 'stats_table_name'
+        """
+        return self._get_table(engine, self.stats_table_name)
+
+def _get_engine(url):
+    """Gets the shared engine for a database url, creating it if needed
+
+    Args:
+        url (str): The database url
+
+    Returns: The sqlalchemy Engine
+    """
+    with _engines_lock:
+        if url not in _engines:
+            _engines[url] = sqlalchemy.create_engine(url)
+        return _engines[url]
+
+def _is_lock_timeout(error):
+    """Checks whether a database error was caused by waiting too long for a lock
+
+    Args:
+        error (sqlalchemy.exc.OperationalError): The error to check
+
+    Returns: True if the statement can be retried later
+    """
+    #55P03 is postgresql's lock_not_available. SQLite reports busy locks by message only
+    return getattr(error.orig, 'pgcode', None) == '55P03' or 'database is locked' in str(error.orig)
+
+def _retry_note(attempts):
+    """Describes how many attempts a schema change took, for the response message
+
+    Args:
+        attempts (int): The number of attempts
+
+    Returns: An empty string if the first attempt succeeded
+    """
+    return '' if attempts == 1 else f' after {attempts} attempts'
 
 def get_safe_column_name(column_name):
     """Get the safe sql column name from the given string
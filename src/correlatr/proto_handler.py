@@ -1,23 +1,48 @@
+import threading
 import traceback
 from datetime import date
 from io import BytesIO
 
 from matplotlib import pyplot
+import numpy
 from pandas import DataFrame
 import seaborn
 
 from protos import client_pb2, server_pb2, shared_pb2
+from .column_stats import stddev
+from .compact import dictionary_version, unpack_values
+from .correlation import find_top_correlations
 from .db_connection import DBConnection, get_safe_column_name
 from .response import create_response
 
+#Above this many points, graphs are drawn as a 2D histogram instead of a scatter plot
+MAX_SCATTER_POINTS = 5000
+HISTOGRAM_BINS = 60
+
+DEFAULT_TOP_K = 10
+MAX_TOP_K = 100
+MAX_LAG = 30
+MAX_CACHED_DISCOVERIES = 32
+
+#Discovered correlations, keyed by the request that found them. Each value is (data_version, correlations)
+_discovery_cache = {}
+_discovery_cache_lock = threading.Lock()
+
+#pyplot keeps global state, so only one graph can be drawn at a time
+_plot_lock = threading.Lock()
+
 class ProtoHandler:
-    def __init__(self, db_url):
+    def __init__(self, db_url, max_scatter_points=MAX_SCATTER_POINTS, reader_urls=None, client_id=None):
         """A class that handles the requested action from a client proto
 
         Args:
             db_url (str): url of the database to connect to
+            max_scatter_points (int): Graphs with more points than this are binned instead of scattered
+            reader_urls ([str]): urls of read replicas of the database
+            client_id (str): Identifies the client that sent the proto
         """
-        self.db_conn = DBConnection(db_url, DBConnection.TABLE_NAME)
+        self.db_conn = DBConnection(db_url, DBConnection.TABLE_NAME, reader_urls, client_id)
+        self.max_scatter_points = max_scatter_points
 
     def handle_proto(self, proto):
         """Handles a protobuf message from the client
@@ -40,18 +65,24 @@ class ProtoHandler:
                 return self._columnsRequest(proto.columnsRequest)
             elif proto.WhichOneof("message") == "dataRequest":
                 return self._data_request(proto.dataRequest)
+            elif proto.WhichOneof("message") == "discoverRequest":
+                return self._discover_request(proto.discoverRequest)
+            elif proto.WhichOneof("message") == "columnStatsRequest":
+                return self._column_stats_request(proto.columnStatsRequest)
         except Exception:
             print(traceback.format_exc())
             return create_response("Unkown server error", True)
 
     def _columnsRequest(self, columns_request):
         print("Columns requested!")
-        columns = self.db_conn.get_all_columns()
+        #Compact writes are checked against the writer's columns, so the dictionary has to come from there too
+        columns = self.db_conn.get_all_columns(from_writer=True)
         response = create_response("columns fetched", False)
         for column in columns:
             data_point = shared_pb2.DataPoint()
             data_point.columnName = column
             response.dataPoints.append(data_point)
+        response.dictionaryVersion = dictionary_version(columns)
 
         return response
 
@@ -74,13 +105,24 @@ class ProtoHandler:
             
         Returns: The response message to send to the client
         """
-        if len(update_data.newData) == 0:
+        if len(update_data.newData) == 0 and len(update_data.compactData.columnIndexes) == 0:
             print("A data update has been requested, but the list of changes was empty!")
             return create_response("No data updates to perform", True)
+        elif len(update_data.newData) == 0:
+            try:
+                data_points = self._dictify_compact_row(update_data.compactData)
+            except ValueError as error:
+                print(f"A compact data update was malformed: {error}")
+                return create_response(f"Malformed compact row: {error}", True)
+            if data_points is None:
+                print("A compact data update used an out of date column dictionary!")
+                return create_response("Column dictionary is out of date", True)
         else:
-            update_data.date = update_data.date // 1000
-            print(f"An update has been requested on date {date.fromtimestamp(update_data.date)}")
-            return self.db_conn.set_data(update_data.date, self._dictify_datapoints(update_data.newData))
+            data_points = self._dictify_datapoints(update_data.newData)
+
+        update_data.date = update_data.date // 1000
+        print(f"An update has been requested on date {date.fromtimestamp(update_data.date)}")
+        return self.db_conn.set_data(update_data.date, data_points)
 
     def _image_request(self, graph_request):
         """Handles an graph_request message
@@ -90,16 +132,121 @@ class ProtoHandler:
             
         Returns: The response message to send to the client
         """
-        points = self.db_conn.get_data_in_columns(graph_request.horizontal, graph_request.vertical)
-        points = DataFrame(points, columns=[graph_request.horizontal, graph_request.vertical])
-        seaborn.lmplot(x=graph_request.horizontal, y=graph_request.vertical, data=points)
+        sums = self.db_conn.get_column_pair_sums(graph_request.horizontal, graph_request.vertical)
+        binned = sums.count > self.max_scatter_points
+        if binned:
+            histogram = self.db_conn.get_binned_data_in_columns(graph_request.horizontal, graph_request.vertical,
+                HISTOGRAM_BINS, sums)
+        else:
+            points = self.db_conn.get_data_in_columns(graph_request.horizontal, graph_request.vertical)
+            points = DataFrame(points, columns=[graph_request.horizontal, graph_request.vertical])
+
+        #Only drawing needs the lock, so graphs can still fetch their data concurrently
         image_bytes = BytesIO()
-        pyplot.savefig(image_bytes)
+        with _plot_lock:
+            if binned:
+                self._plot_histogram(graph_request.horizontal, graph_request.vertical, sums, histogram)
+            else:
+                seaborn.lmplot(x=graph_request.horizontal, y=graph_request.vertical, data=points)
+            pyplot.savefig(image_bytes)
+            pyplot.close('all')
         response = create_response("Success", False)
         response.graphImage = image_bytes.getvalue()
         print("A graph has been requested!")
         return response
 
+    def _discover_request(self, discover_request):
+        """Handles a discover_request message
+
+        Results are cached until the data in the table changes. Results read from a replica
+        are not cached, as the replica may not have caught up to the current data version
+
+        Args:
+            discover_request (client_pb2.DiscoverRequest): The message to handle
+
+        Returns: The response message to send to the client
+        """
+        top_k = min(discover_request.topK or DEFAULT_TOP_K, MAX_TOP_K)
+        max_lag = min(max(discover_request.maxLag, 0), MAX_LAG)
+        print(f"Correlation discovery requested for the top {top_k} pairs with lags up to {max_lag} days!")
+
+        cache_key = (self.db_conn.url, self.db_conn.table_name, top_k, max_lag)
+        version = self.db_conn.data_version
+        with _discovery_cache_lock:
+            cached = _discovery_cache.get(cache_key)
+
+        if cached is not None and cached[0] == version:
+            correlations = cached[1]
+        else:
+            dates, columns, values = self.db_conn.get_all_data()
+            correlations = find_top_correlations(dates, columns, values, top_k, max_lag)
+            if self.db_conn.reads_from_writer:
+                with _discovery_cache_lock:
+                    if len(_discovery_cache) >= MAX_CACHED_DISCOVERIES:
+                        _discovery_cache.clear()
+                    _discovery_cache[cache_key] = (version, correlations)
+
+        response = create_response(f"Found {len(correlations)} correlations", False)
+        for correlation in correlations:
+            correlation_proto = response.correlations.add()
+            correlation_proto.column1 = correlation.column1
+            correlation_proto.column2 = correlation.column2
+            correlation_proto.lag = correlation.lag
+            correlation_proto.r = correlation.r
+            correlation_proto.n = correlation.n
+            correlation_proto.pValue = correlation.p_value
+            correlation_proto.adjustedPValue = correlation.adjusted_p_value
+        return response
+
+    def _plot_histogram(self, horizontal, vertical, sums, histogram):
+        """Plots a 2D histogram of two columns, binned by the database, with a regression line
+        fitted on every point
+
+        Args:
+            horizontal (str): Column to plot on the x axis
+            vertical (str): Column to plot on the y axis
+            sums (db_connection.ColumnPairSums): The count, sums and bounds of the columns
+            histogram (tuple): The (x bin edges, y bin edges, counts) from get_binned_data_in_columns
+        """
+        x_edges, y_edges, counts = histogram
+        pyplot.figure()
+        mesh = pyplot.pcolormesh(x_edges, y_edges, numpy.ma.masked_equal(counts, 0).T, cmap='Blues', vmin=0)
+        pyplot.colorbar(mesh, label='Points')
+
+        slope, intercept = _linear_fit(sums)
+        if slope is not None:
+            line_x = numpy.array([x_edges[0], x_edges[-1]])
+            pyplot.plot(line_x, slope * line_x + intercept, color='tab:orange')
+
+        pyplot.xlabel(horizontal)
+        pyplot.ylabel(vertical)
+        pyplot.tight_layout()
+
+    def _column_stats_request(self, _column_stats_request):
+        """Handles a column_stats_request message
+
+        Args:
+            column_stats_request (client_pb2.ColumnStatsRequest): The message to handle
+
+        Returns: The response message to send to the client
+        """
+        print("Column statistics requested!")
+        response = create_response("column statistics fetched", False)
+        for column, stats in self.db_conn.get_column_stats():
+            stats_proto = response.columnStats.add()
+            stats_proto.columnName = column
+            stats_proto.count = stats['COUNT']
+            if stats['COUNT']:
+                stats_proto.mean = stats['MEAN']
+                stats_proto.stddev = stddev(stats)
+                stats_proto.min = stats['MIN']
+                stats_proto.max = stats['MAX']
+                stats_proto.lastValue = stats['LAST_VALUE']
+                #Dates are stored in seconds, but clients use milliseconds
+                stats_proto.firstDate = stats['FIRST_DATE'] * 1000
+                stats_proto.lastDate = stats['LAST_DATE'] * 1000
+        return response
+
     def _column_change(self, change_column_message):
         """Handles a change_column message
         
@@ -130,7 +277,7 @@ class ProtoHandler:
         """
         data_request_message.date = data_request_message.date // 1000
         print(f'Data requested for date {date.fromtimestamp(data_request_message.date)}!')
-        return self.db_conn.get_data_for_date(data_request_message.date)
+        return self.db_conn.get_data_for_date(data_request_message.date, data_request_message.compact)
 
     def _dictify_datapoints(self, data_points):
         """Converts a list of datapoints to a dict
@@ -147,3 +294,42 @@ class ProtoHandler:
             else:
                 result[point.columnName] = None
         return result
+
+    def _dictify_compact_row(self, compact_row):
+        """Converts a compact row to a dict
+
+        Args:
+            compact_row (shared_pb2.CompactRow): Row to dictify
+
+        Returns: Dict containing the row's values keyed by column name,
+            or None if the row was made with a different column dictionary
+
+        Raises: ValueError if the row is malformed
+        """
+        #The row is written to the writer, so its indexes must refer to the writer's columns
+        columns = self.db_conn.get_all_columns(from_writer=True)
+        if compact_row.dictionaryVersion != dictionary_version(columns):
+            return None
+        values = unpack_values(compact_row.values, compact_row.nullBitmap)
+        if len(values) != len(compact_row.columnIndexes):
+            raise ValueError(f"{len(values)} values for {len(compact_row.columnIndexes)} column indexes")
+        if any(i >= len(columns) for i in compact_row.columnIndexes):
+            raise ValueError(f"Column index out of range for {len(columns)} columns")
+        if len(set(compact_row.columnIndexes)) != len(compact_row.columnIndexes):
+            raise ValueError("Column indexes are repeated")
+        return {columns[i]: value for i, value in zip(compact_row.columnIndexes, values)}
+
+def _linear_fit(sums):
+    """Fits a least squares line from the count and sums of two columns
+
+    Args:
+        sums (db_connection.ColumnPairSums): The count and sums of the columns
+
+    Returns: A tuple of (slope, intercept), which are None if every x value is the same
+    """
+    denominator = sums.count * sums.sum_xx - sums.sum_x * sums.sum_x
+    if denominator <= 0:
+        return None, None
+    slope = (sums.count * sums.sum_xy - sums.sum_x * sums.sum_y) / denominator
+    intercept = (sums.sum_y - slope * sums.sum_x) / sums.count
+    return slope, intercept
@@ -3,16 +3,23 @@ import socketserver
 from google.protobuf.reflection import ParseMessage
 
 from protos import client_pb2
-from .proto_handler import ProtoHandler
+from .compact import compress_payload, frame_header
+from .proto_handler import MAX_SCATTER_POINTS, ProtoHandler
+from .scheduler import Scheduler
 
-def request_handler_factory(url):
+def request_handler_factory(url, reader_urls=None, max_scatter_points=MAX_SCATTER_POINTS):
     """Returns a RequestHandler class that uses the database
     at the given url
 
     Args:
         url (str): url of the database to connect to
+        reader_urls ([str]): urls of read replicas of the database
+        max_scatter_points (int): Graphs of more points than this are drawn as histograms
     """
     class ClientRequestHandler(socketserver.BaseRequestHandler):
+        #Shared by every connection, so that load is tracked across the whole server
+        scheduler = Scheduler()
+
         def setup(self):
             """Inhereted from base class"""
             print(f"Receiving a new connection from {self.client_address[0]}!")
@@ -23,14 +30,28 @@ def request_handler_factory(url):
             data = self._read_data(data_len)
 
             proto = ParseMessage(client_pb2.ClientMessage.DESCRIPTOR, data)
-            response = ProtoHandler(url).handle_proto(proto).SerializeToString()
-            self.request.send(len(response).to_bytes(4, byteorder="big"))
+            response = self.scheduler.submit(self.client_address[0], proto, self._handle_proto).SerializeToString()
+            compressed = False
+            if proto.acceptCompression:
+                response, compressed = compress_payload(response)
+            self.request.send(frame_header(len(response), compressed))
             self.request.send(response)
 
         def finish(self):
             """Inhereted from base class"""
             print(f"Closing connection with {self.client_address[0]}!")
 
+        def _handle_proto(self, proto):
+            """Handles a protobuf message once the scheduler has admitted it
+
+            Args:
+                proto (client_pb2.ClientMessage): The message to handle
+
+            Returns: The response message to send to the client
+            """
+            return ProtoHandler(url, max_scatter_points=max_scatter_points, reader_urls=reader_urls,
+                client_id=self.client_address[0]).handle_proto(proto)
+
         def _read_data(self, data_len):
             """Reads a specified number of bytes from the TCP stream.
 
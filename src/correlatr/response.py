@@ -11,3 +11,11 @@ def create_response(message, error):
     response.statusMessage.text = message
     response.statusMessage.error = error
     return response
+
+def create_busy_response(retry_after):
+    """Creates an error response telling the client the server is shedding load
+
+    Args:
+        retry_after (int): Seconds the client should wait before retrying
+    """
+    return create_response(f"Server busy, retry after {max(retry_after, 1)} seconds", True)
@@ -0,0 +1,230 @@
+"""Admission control for client messages, so that bursts of expensive requests cannot starve cheap ones"""
+import math
+import threading
+import time
+from collections import namedtuple
+
+from .db_connection import SCHEMA_CHANGE_MAX_SECONDS
+from .response import create_busy_response
+
+ClassLimits = namedtuple('ClassLimits', ['concurrency', 'queue_size', 'max_wait', 'cost'])
+
+#Which class each type of client message is scheduled as. Unknown messages are treated as cheap
+MESSAGE_CLASSES = {
+    'ping': 'cheap',
+    'columnsRequest': 'cheap',
+    'dataRequest': 'cheap',
+    'columnStatsRequest': 'cheap',
+    'updateData': 'write',
+    'changeColumn': 'schema',
+    'graphRequest': 'expensive',
+    'discoverRequest': 'expensive',
+}
+
+DEFAULT_LIMITS = {
+    'cheap': ClassLimits(concurrency=8, queue_size=64, max_wait=1.0, cost=1),
+    'write': ClassLimits(concurrency=4, queue_size=32, max_wait=5.0, cost=1),
+    #Column changes run one at a time on the schema change thread anyway, and each can take its whole retry budget
+    'schema': ClassLimits(concurrency=1, queue_size=8, max_wait=SCHEMA_CHANGE_MAX_SECONDS, cost=1),
+    'expensive': ClassLimits(concurrency=2, queue_size=8, max_wait=10.0, cost=5),
+}
+
+CLIENT_RATE = 10.0
+CLIENT_BURST = 30.0
+MAX_TRACKED_CLIENTS = 1024
+
+class Scheduler:
+    def __init__(self, limits=None, client_rate=CLIENT_RATE, client_burst=CLIENT_BURST, clock=time.monotonic):
+        """Limits how many messages of each class run at once, how many may wait, and how
+        fast each client may send them
+
+        Each client has a token bucket refilled at client_rate tokens per second. Every message
+        the server admits costs its class's cost in tokens
+
+        Args:
+            limits (dict): ClassLimits for each message class. Defaults to DEFAULT_LIMITS
+            client_rate (float): Tokens given to each client per second
+            client_burst (float): Most tokens a client can save up
+            clock (callable): Returns the current time in seconds
+        """
+        self._limits = limits or DEFAULT_LIMITS
+        self._client_rate = client_rate
+        self._client_burst = client_burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._queues = {name: _ClassQueue(limit) for name, limit in self._limits.items()}
+
+    def submit(self, client, proto, handler):
+        """Runs handler on proto once there is capacity, or rejects it with a busy response
+
+        Args:
+            client (str): Identifies the client that sent the message, for rate limiting
+            proto (client_pb2.ClientMessage): The message to handle
+            handler (callable): Takes proto and returns the response message
+
+        Returns: The response message to send to the client
+        """
+        message_class = MESSAGE_CLASSES.get(proto.WhichOneof("message"), 'cheap')
+        queue = self._queues[message_class]
+
+        with self._lock:
+            wait_estimate = queue.wait_estimate()
+            if queue.is_saturated() and queue.waiting >= queue.limits.queue_size:
+                return self._reject(queue, message_class, "queue is full", wait_estimate, locked=True)
+            if wait_estimate > queue.limits.max_wait:
+                return self._reject(queue, message_class, "expected wait is too long", wait_estimate, locked=True)
+            #Only charged once the server would accept the message, so clients do not pay for load shedding
+            retry_after = self._take_tokens(client, queue.limits.cost)
+            if retry_after:
+                return self._reject(queue, message_class, f"{client} is over its rate limit", retry_after,
+                    locked=True, rate_limited=True)
+            queue.waiting += 1
+
+        acquired = queue.semaphore.acquire(timeout=queue.limits.max_wait)
+        with self._lock:
+            queue.waiting -= 1
+            if acquired:
+                queue.in_flight += 1
+            else:
+                self._refund_tokens(client, queue.limits.cost)
+        if not acquired:
+            return self._reject(queue, message_class, "timed out waiting", queue.limits.max_wait)
+
+        start = self._clock()
+        try:
+            return handler(proto)
+        finally:
+            with self._lock:
+                queue.in_flight -= 1
+                queue.completed += 1
+                queue.record_service_time(self._clock() - start)
+            queue.semaphore.release()
+
+    def stats(self):
+        """Gets the current state of every message class
+
+        Returns: A dict of message class to a dict of waiting, in_flight, completed, rejected and
+            rate_limited counts. rejected counts messages shed because the server was busy, and
+            rate_limited counts messages from clients that were over their rate limit
+        """
+        with self._lock:
+            return {name: {'waiting': queue.waiting, 'in_flight': queue.in_flight,
+                'completed': queue.completed, 'rejected': queue.rejected, 'rate_limited': queue.rate_limited}
+                for name, queue in self._queues.items()}
+
+    def _take_tokens(self, client, cost):
+        """Takes cost tokens from the client's bucket. Must hold self._lock
+
+        Args:
+            client (str): The client sending a message
+            cost (float): Tokens the message costs
+
+        Returns: 0 if the tokens were taken, or else the seconds until the client has enough
+        """
+        now = self._clock()
+        if client not in self._buckets and len(self._buckets) >= MAX_TRACKED_CLIENTS:
+            self._forget_idle_clients(now)
+        tokens, last_time = self._buckets.get(client, (self._client_burst, now))
+        tokens = min(self._client_burst, tokens + (now - last_time) * self._client_rate)
+        if tokens < cost:
+            self._buckets[client] = (tokens, now)
+            return (cost - tokens) / self._client_rate
+        self._buckets[client] = (tokens - cost, now)
+        return 0
+
+    def _refund_tokens(self, client, cost):
+        """Gives back tokens taken for a message that was rejected after all. Must hold self._lock
+
+        Args:
+            client (str): The client that sent the message
+            cost (float): Tokens the message cost
+        """
+        if client in self._buckets:
+            tokens, last_time = self._buckets[client]
+            self._buckets[client] = (min(self._client_burst, tokens + cost), last_time)
+
+    def _forget_idle_clients(self, now):
+        """Drops the buckets of clients that would be full by now. Must hold self._lock
+
+        Args:
+            now (float): The current time
+        """
+        refill_time = self._client_burst / self._client_rate
+        for client, (_, last_time) in list(self._buckets.items()):
+            if now - last_time >= refill_time:
+                del self._buckets[client]
+
+    def _reject(self, queue, message_class, reason, retry_after, locked=False, rate_limited=False):
+        """Counts a rejected message and creates the busy response for it
+
+        Args:
+            queue (_ClassQueue): Queue the message was rejected from
+            message_class (str): Name of the queue's message class
+            reason (str): Why the message was rejected
+            retry_after (float): Seconds the client should wait before retrying
+            locked (bool): Whether the caller already holds self._lock
+            rate_limited (bool): Whether the message was rejected for its client's rate rather than the server's load
+
+        Returns: The response message to send to the client
+        """
+        if locked:
+            self._count_rejection(queue, rate_limited)
+        else:
+            with self._lock:
+                self._count_rejection(queue, rate_limited)
+        print(f"Rejecting a {message_class} message: {reason}. {queue.waiting} waiting, "
+            f"{queue.in_flight} in flight, {queue.rejected} rejected, {queue.rate_limited} rate limited")
+        return create_busy_response(math.ceil(retry_after))
+
+    def _count_rejection(self, queue, rate_limited):
+        """Counts a rejected message. Must hold self._lock
+
+        Args:
+            queue (_ClassQueue): Queue the message was rejected from
+            rate_limited (bool): Whether the message was rejected for its client's rate
+        """
+        if rate_limited:
+            queue.rate_limited += 1
+        else:
+            queue.rejected += 1
+
+class _ClassQueue:
+    #Weight given to the newest sample in the moving average of service times
+    SMOOTHING = 0.2
+
+    def __init__(self, limits):
+        """Bookkeeping for a single message class
+
+        Args:
+            limits (ClassLimits): The limits of the message class
+        """
+        self.limits = limits
+        self.semaphore = threading.BoundedSemaphore(limits.concurrency)
+        self.waiting = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.average_service_time = 0.0
+
+    def record_service_time(self, seconds):
+        """Adds a service time to the moving average
+
+        Args:
+            seconds (float): How long a message took to handle
+        """
+        self.average_service_time += self.SMOOTHING * (seconds - self.average_service_time)
+
+    def is_saturated(self):
+        """Whether a new message would have to wait for a free slot"""
+        return self.in_flight + self.waiting >= self.limits.concurrency
+
+    def wait_estimate(self):
+        """Estimates how long a new message would wait before it starts running
+
+        Returns: The estimate in seconds
+        """
+        if not self.is_saturated():
+            return 0.0
+        return (self.waiting + 1) * self.average_service_time / self.limits.concurrency
@@ -0,0 +1,34 @@
+"""Python script that verifies the column statistics table against the user data, and rebuilds it.
+Safe to run while the server is serving clients
+"""
+import argparse
+
+from ..db_connection import DBConnection, get_safe_column_name
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Verify and rebuild the column statistics')
+    parser.add_argument('db_url', metavar='db_url', type=str,
+                        help='url of the database that all writes go to')
+    parser.add_argument('--verify-only', action='store_true',
+                        help='only report columns with wrong statistics, without rebuilding them')
+    parser.add_argument('--all', action='store_true',
+                        help='rebuild every column, not only those with wrong statistics')
+    args = parser.parse_args()
+
+    db_conn = DBConnection(args.db_url, DBConnection.TABLE_NAME)
+    mismatched = db_conn.verify_column_stats()
+    for column in mismatched:
+        print(f"Statistics for {column} are out of date")
+    print(f"{len(mismatched)} columns have out of date statistics")
+
+    if args.verify_only:
+        return
+    if args.all:
+        rebuilt = db_conn.rebuild_column_stats()
+    else:
+        rebuilt = db_conn.rebuild_column_stats([get_safe_column_name(column) for column in mismatched])
+    print(f"Rebuilt statistics for {len(rebuilt)} columns")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import statistics
+from unittest import TestCase
+
+from correlatr import column_stats
+
+class TestColumnStats(TestCase):
+    def setUp(self):
+        self.date_values = [(1, 5.0), (2, 0.0), (3, 6.08), (5, -2.5)]
+        self.stats = column_stats.compute_stats(self.date_values)
+
+    def test_compute_stats(self):
+        values = [value for _, value in self.date_values]
+        self.assertEqual(self.stats['COUNT'], 4)
+        self.assertAlmostEqual(self.stats['MEAN'], statistics.mean(values))
+        self.assertAlmostEqual(column_stats.stddev(self.stats), statistics.stdev(values))
+        self.assertEqual((self.stats['MIN'], self.stats['MAX']), (-2.5, 6.08))
+        self.assertEqual((self.stats['FIRST_DATE'], self.stats['LAST_DATE'], self.stats['LAST_VALUE']), (1, 5, -2.5))
+        self.assertFalse(self.stats['STALE'])
+
+    def test_compute_stats_empty(self):
+        stats = column_stats.compute_stats([])
+        self.assertEqual(stats, column_stats.empty_stats())
+        self.assertEqual(column_stats.stddev(stats), 0.0)
+
+    def test_compute_stats_stable(self):
+        values = [1e9 + 4, 1e9 + 7, 1e9 + 13, 1e9 + 16]
+        stats = column_stats.compute_stats(enumerate(values))
+        self.assertAlmostEqual(column_stats.stddev(stats), statistics.stdev(values))
+
+    def test_apply_change_add(self):
+        column_stats.apply_change(self.stats, 4, None, 1.0)
+        expected = column_stats.compute_stats(sorted(self.date_values + [(4, 1.0)]))
+        self.assertTrue(column_stats.stats_match(self.stats, expected))
+        self.assertFalse(self.stats['STALE'])
+
+    def test_apply_change_replace(self):
+        column_stats.apply_change(self.stats, 3, 6.08, 3.0)
+        expected = column_stats.compute_stats([(1, 5.0), (2, 0.0), (3, 3.0), (5, -2.5)])
+        self.assertEqual(self.stats['COUNT'], expected['COUNT'])
+        self.assertAlmostEqual(self.stats['MEAN'], expected['MEAN'])
+        self.assertAlmostEqual(self.stats['M2'], expected['M2'])
+        #6.08 was the max, which cannot be recovered without a scan
+        self.assertTrue(self.stats['STALE'])
+
+    def test_apply_change_replace_repeated_extreme(self):
+        stats = column_stats.compute_stats([(1, 0.0), (2, 1.0), (3, 0.0), (4, 1.0)])
+        column_stats.apply_change(stats, 2, 1.0, 0.0)
+        column_stats.apply_change(stats, 3, 0.0, 1.0)
+        expected = column_stats.compute_stats([(1, 0.0), (2, 0.0), (3, 1.0), (4, 1.0)])
+        self.assertTrue(column_stats.stats_match(stats, expected))
+        self.assertFalse(stats['STALE'])
+
+        column_stats.apply_change(stats, 3, 1.0, 0.5)
+        self.assertFalse(stats['STALE'])
+        column_stats.apply_change(stats, 4, 1.0, 0.5)
+        self.assertTrue(stats['STALE'])
+
+    def test_apply_change_replace_last(self):
+        column_stats.apply_change(self.stats, 5, -2.5, 4.0)
+        self.assertEqual(self.stats['LAST_VALUE'], 4.0)
+
+    def test_apply_change_remove(self):
+        column_stats.apply_change(self.stats, 2, 0.0, None)
+        expected = column_stats.compute_stats([(1, 5.0), (3, 6.08), (5, -2.5)])
+        self.assertTrue(column_stats.stats_match(self.stats, expected))
+        self.assertFalse(self.stats['STALE'])
+
+        column_stats.apply_change(self.stats, 5, -2.5, None)
+        self.assertTrue(self.stats['STALE'])
+
+    def test_apply_change_remove_only_value(self):
+        stats = column_stats.compute_stats([(1, 5.0)])
+        column_stats.apply_change(stats, 1, 5.0, None)
+        self.assertEqual(stats, column_stats.empty_stats())
+
+    def test_stats_match(self):
+        expected = column_stats.compute_stats(self.date_values)
+        self.assertTrue(column_stats.stats_match(self.stats, expected))
+        self.stats['MEAN'] += 1e-3
+        self.assertFalse(column_stats.stats_match(self.stats, expected))
@@ -0,0 +1,46 @@
+from unittest import TestCase
+
+from correlatr import compact
+
+class TestCompact(TestCase):
+    def test_dictionary_version(self):
+        version = compact.dictionary_version(['foo', 'bar'])
+        self.assertEqual(version, compact.dictionary_version(['foo', 'bar']))
+        self.assertNotEqual(version, compact.dictionary_version(['bar', 'foo']))
+        self.assertNotEqual(version, compact.dictionary_version(['foo', 'bar', 'baz']))
+
+    def test_pack_values(self):
+        values = [5.0, None, 6.08, 0.0, None, None, None, None, -1.5]
+        packed, bitmap = compact.pack_values(values)
+        self.assertEqual(len(packed), 8 * len(values))
+        self.assertEqual(bitmap, bytes([0b11110010, 0b0]))
+        self.assertEqual(compact.unpack_values(packed, bitmap), values)
+
+    def test_pack_values_empty(self):
+        packed, bitmap = compact.pack_values([])
+        self.assertEqual(compact.unpack_values(packed, bitmap), [])
+
+    def test_unpack_values_malformed(self):
+        packed, bitmap = compact.pack_values([1.0, None])
+        with self.assertRaises(ValueError):
+            compact.unpack_values(packed[:-1], bitmap)
+        with self.assertRaises(ValueError):
+            compact.unpack_values(packed, b'')
+        with self.assertRaises(ValueError):
+            compact.unpack_values(packed, bitmap + b'\0')
+
+    def test_compress_payload(self):
+        small = b'foo'
+        self.assertEqual(compact.compress_payload(small), (small, False))
+
+        large = b'foo' * compact.COMPRESSION_THRESHOLD
+        payload, compressed = compact.compress_payload(large)
+        self.assertTrue(compressed)
+        self.assertLess(len(payload), len(large))
+
+    def test_frame_header(self):
+        for length, compressed in [(0, False), (1337, False), (1337, True)]:
+            header = compact.frame_header(length, compressed)
+            self.assertEqual(len(header), 4)
+            self.assertEqual(compact.parse_frame_header(header), (length, compressed))
+        self.assertEqual(compact.frame_header(1337, False), (1337).to_bytes(4, byteorder="big"))
@@ -0,0 +1,60 @@
+from unittest import TestCase
+
+import numpy
+
+from correlatr import correlation
+
+class TestCorrelation(TestCase):
+    def setUp(self):
+        self.dates = numpy.arange(10, dtype=float) * correlation.SECONDS_PER_DAY
+        self.foo = numpy.arange(10, dtype=float)
+        self.bar = self.foo * 2 + 1
+        self.baz = numpy.array([3, 1, 4, 1, 5, 9, 2, 6, 5, 3], dtype=float)
+        self.values = numpy.column_stack([self.foo, self.bar, self.baz])
+        self.columns = ['foo', 'bar', 'baz']
+
+    def test_pairwise_correlations(self):
+        r, n = correlation.pairwise_correlations(self.values, self.values)
+        expected = numpy.corrcoef(self.values, rowvar=False)
+        numpy.testing.assert_allclose(r, expected)
+        self.assertTrue((n == 10).all())
+
+    def test_pairwise_correlations_blocked(self):
+        r, n = correlation.pairwise_correlations(self.values, self.values, workers=2, block_size=1)
+        expected = numpy.corrcoef(self.values, rowvar=False)
+        numpy.testing.assert_allclose(r, expected)
+
+    def test_pairwise_correlations_ignores_unset(self):
+        self.values[0, 0] = numpy.nan
+        self.values[9, 1] = numpy.nan
+        r, n = correlation.pairwise_correlations(self.values, self.values)
+        self.assertEqual(n[0, 1], 8)
+        self.assertEqual(n[0, 2], 9)
+        self.assertAlmostEqual(r[0, 1], 1.0)
+
+    def test_benjamini_hochberg(self):
+        adjusted = correlation.benjamini_hochberg([0.01, 0.04, 0.03, 0.5])
+        numpy.testing.assert_allclose(adjusted, [0.04, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.5])
+
+    def test_find_top_correlations(self):
+        result = correlation.find_top_correlations(self.dates, self.columns, self.values, 1)
+        self.assertEqual(len(result), 1)
+        self.assertEqual((result[0].column1, result[0].column2), ('foo', 'bar'))
+        self.assertAlmostEqual(result[0].r, 1.0)
+        self.assertEqual(result[0].n, 10)
+        self.assertLess(result[0].adjusted_p_value, correlation.SIGNIFICANCE_LEVEL)
+
+    def test_find_top_correlations_lagged(self):
+        values = numpy.column_stack([self.baz, numpy.roll(self.baz, 2)])
+        result = correlation.find_top_correlations(self.dates, ['foo', 'bar'], values, 1, max_lag=2)
+        self.assertEqual((result[0].column1, result[0].column2, result[0].lag), ('foo', 'bar', 2))
+        self.assertEqual(result[0].n, 8)
+        self.assertAlmostEqual(result[0].r, 1.0)
+
+    def test_lag_values_daylight_saving(self):
+        #A 23 hour day, then a 25 hour day
+        dates = numpy.array([0, 1, 2, 3], dtype=float) * correlation.SECONDS_PER_DAY + [0, 0, -3600, 0]
+        values = numpy.arange(4.0).reshape((4, 1))
+        lagged = correlation._lag_values(dates, values, 1)
+        self.assertListEqual(lagged[:3, 0].tolist(), [1.0, 2.0, 3.0])
+        self.assertTrue(numpy.isnan(lagged[3, 0]))
@@ -1,10 +1,14 @@
 import subprocess
+import tempfile
+import threading
+import time
 from unittest import TestCase, mock
 
+import numpy
 import sqlalchemy
 from sqlalchemy.ext.declarative import declarative_base
 
-from correlatr import db_connection
+from correlatr import column_stats, db_connection
 from protos import shared_pb2
 
 class TestDbConnection(TestCase):
@@ -35,6 +39,7 @@ class TestDbConnection(TestCase):
         #Simply removing columns will not work
         # https://nerderati.com/2017/01/03/postgresql-tables-can-have-at-most-1600-columns/
         self.db_conn._engine.execute(f'DROP TABLE {self.table_name};')
+        self.db_conn._engine.execute(f'DROP TABLE {self.db_conn.stats_table_name};')
 
     def test_get_safe_column_name(self):
         actual = db_connection.get_safe_column_name(self.column_name)
@@ -127,6 +132,25 @@ class TestDbConnection(TestCase):
         self.assertTrue(db_connection.get_safe_column_name(self.column_name) in self.db_conn._get_table().c)
         self.assertEqual(len(self.db_conn._get_table().c), 2)
 
+    def test_add_column_lock_timeout(self):
+        connection = self.db_conn._engine.connect()
+        transaction = connection.begin()
+        connection.execute(f'SELECT * FROM {self.table_name}')
+
+        with mock.patch.object(db_connection, 'SCHEMA_CHANGE_ATTEMPTS', 2), \
+                mock.patch.object(db_connection, 'SCHEMA_LOCK_TIMEOUT_MS', 10), \
+                mock.patch.object(db_connection, 'SCHEMA_CHANGE_BACKOFF', 0):
+            result = self.db_conn.add_column(self.column_name)
+        transaction.rollback()
+        connection.close()
+
+        self.assertTrue(result.statusMessage.error)
+        self.assertEqual(len(self.db_conn._get_table().c), 1)
+
+        result = self.db_conn.add_column(self.column_name)
+        self.assertFalse(result.statusMessage.error)
+        self.assertEqual(len(self.db_conn._get_table().c), 2)
+
     def test_get_all_columns(self):
         for column in self.columns:
             self.db_conn.add_column(column)
@@ -181,3 +205,222 @@ class TestDbConnection(TestCase):
 
         result = self.db_conn.get_data_in_columns('foo', 'bar')
         self.assertListEqual(result, [(5.0, 0.0), (7.0, 12.0)])
+
+    def test_get_column_stats(self):
+        for column in self.columns:
+            self.db_conn.add_column(column)
+
+        self.db_conn.set_data(1, self.data_points)
+        self.db_conn.set_data(2, {'foo': 7, 'bar': 12})
+        self.db_conn.set_data(3, {'foo': 3})
+        self.db_conn.set_data(2, {'foo': 4})
+
+        #Replacing 7, the only max, leaves the statistics to be rebuilt in the background
+        self.db_conn.get_column_stats()
+        self._wait_for_stats_rebuilds()
+        stats = dict(self.db_conn.get_column_stats())
+        self.assertListEqual(list(stats), self.columns)
+        self.assertEqual(stats['foo']['COUNT'], 3)
+        self.assertAlmostEqual(stats['foo']['MEAN'], 4.0)
+        self.assertAlmostEqual(stats['foo']['M2'], 2.0)
+        self.assertEqual((stats['foo']['MIN'], stats['foo']['MAX']), (3.0, 5.0))
+        self.assertEqual((stats['foo']['FIRST_DATE'], stats['foo']['LAST_DATE']), (1, 3))
+        self.assertEqual(stats['foo']['LAST_VALUE'], 3.0)
+        self.assertEqual(stats['hello world']['COUNT'], 1)
+        self.assertListEqual(self.db_conn.verify_column_stats(), [])
+
+    def test_get_column_stats_rebuilds_stale(self):
+        self.db_conn.add_column(self.column_name)
+        self.db_conn.set_data(1, {'foo': 1})
+        self.db_conn.set_data(2, {'foo': 2})
+        self.db_conn.set_data(2, {'foo': None})
+
+        stats = dict(self.db_conn.get_column_stats())
+        self.assertTrue(stats['foo']['STALE'])
+        self.assertEqual((stats['foo']['MAX'], stats['foo']['LAST_DATE']), (2.0, 2))
+
+        self._wait_for_stats_rebuilds()
+        stats = dict(self.db_conn.get_column_stats())
+        self.assertFalse(stats['foo']['STALE'])
+        self.assertEqual(stats['foo']['COUNT'], 1)
+        self.assertEqual((stats['foo']['MAX'], stats['foo']['LAST_DATE']), (1.0, 1))
+        self.assertListEqual(self.db_conn.verify_column_stats(), [])
+
+    def test_rebuild_column_stats_during_set_data(self):
+        self.db_conn.add_column(self.column_name)
+        self.db_conn.set_data(1, {'foo': 1})
+        self.db_conn.set_data(2, {'foo': 2})
+
+        scanned = threading.Event()
+        release = threading.Event()
+        compute_stats = column_stats.compute_stats
+        def paused_compute_stats(date_values):
+            stats = compute_stats(date_values)
+            scanned.set()
+            release.wait()
+            return stats
+
+        with mock.patch.object(column_stats, 'compute_stats', paused_compute_stats):
+            rebuild = threading.Thread(target=self.db_conn.rebuild_column_stats, args=([self.safe_column_name],))
+            rebuild.start()
+            scanned.wait()
+            #The rebuild has read the column, so it cannot see this change. It has to wait for the stats row
+            writer = threading.Thread(target=self.db_conn.set_data, args=(2, {'foo': 5}))
+            writer.start()
+            self._wait_for_lock_waits()
+            release.set()
+            rebuild.join()
+            writer.join()
+
+        stats = dict(self.db_conn.get_column_stats())
+        self.assertEqual((stats['foo']['COUNT'], stats['foo']['MAX']), (2, 5.0))
+        self.assertListEqual(self.db_conn.verify_column_stats(), [])
+
+    def test_get_column_stats_keeps_repeated_extremes(self):
+        self.db_conn.add_column(self.column_name)
+        for date in range(4):
+            self.db_conn.set_data(date, {'foo': date % 2})
+        self.db_conn.set_data(1, {'foo': 0})
+        self.db_conn.set_data(2, {'foo': 1})
+
+        stats = dict(self.db_conn.get_column_stats())
+        self.assertFalse(stats['foo']['STALE'])
+        self.assertEqual((stats['foo']['MIN'], stats['foo']['MAX']), (0.0, 1.0))
+        self.assertListEqual(self.db_conn.verify_column_stats(), [])
+
+    def test_column_stats_follow_column_changes(self):
+        self.db_conn.add_column(self.column_name)
+        self.db_conn.add_column('bar')
+        self.db_conn.set_data(1, {'foo': 1, 'bar': 2})
+        self.db_conn.rename_column(self.column_name, 'baz')
+        self.db_conn.remove_column('bar')
+
+        stats = self.db_conn.get_column_stats()
+        self.assertListEqual([column for column, _ in stats], ['baz'])
+        self.assertEqual(stats[0][1]['COUNT'], 1)
+        self.assertListEqual(self.db_conn.verify_column_stats(), [])
+
+    def _wait_for_lock_waits(self, timeout=5):
+        """Waits until a query is blocked waiting for a lock"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            waiting = self.db_conn._engine.execute(
+                "SELECT count(*) FROM pg_stat_activity WHERE wait_event_type = 'Lock'").scalar()
+            if waiting:
+                return
+            time.sleep(0.01)
+        self.fail("Nothing waited for a lock")
+
+    def _wait_for_stats_rebuilds(self):
+        """Waits for every queued column statistics rebuild to finish"""
+        db_connection._stats_rebuild_executor.submit(lambda: None).result()
+
+    def test_get_column_pair_sums(self):
+        for column in self.columns:
+            self.db_conn.add_column(column)
+
+        self.db_conn.set_data(1, self.data_points)
+        self.db_conn.set_data(2, {'foo': 7, 'bar': 12})
+        self.db_conn.set_data(3, {'foo': 3})
+
+        result = self.db_conn.get_column_pair_sums('foo', 'bar')
+        self.assertEqual(result.count, 2)
+        self.assertAlmostEqual(result.sum_x, 12.0)
+        self.assertAlmostEqual(result.sum_y, 12.0)
+        self.assertAlmostEqual(result.sum_xx, 74.0)
+        self.assertAlmostEqual(result.sum_xy, 84.0)
+        self.assertEqual((result.min_x, result.max_x, result.min_y, result.max_y), (5.0, 7.0, 0.0, 12.0))
+
+    def test_get_binned_data_in_columns(self):
+        for column in self.columns:
+            self.db_conn.add_column(column)
+
+        for date in range(10):
+            self.db_conn.set_data(date, {'foo': date, 'bar': 9 - date})
+
+        sums = self.db_conn.get_column_pair_sums('foo', 'bar')
+        x_edges, y_edges, counts = self.db_conn.get_binned_data_in_columns('foo', 'bar', 2, sums)
+        numpy.testing.assert_allclose(x_edges, [0, 4.5, 9])
+        numpy.testing.assert_allclose(y_edges, [0, 4.5, 9])
+        self.assertListEqual(counts.tolist(), [[0, 5], [5, 0]])
+
+    def test_get_binned_data_in_columns_outside_bounds(self):
+        for column in self.columns:
+            self.db_conn.add_column(column)
+
+        for date in range(10):
+            self.db_conn.set_data(date, {'foo': date, 'bar': 9 - date})
+
+        sums = self.db_conn.get_column_pair_sums('foo', 'bar')
+        #Far enough outside the bounds that the bin index would not fit in an integer
+        self.db_conn.set_data(10, {'foo': -1e12, 'bar': 1e12})
+        _, _, counts = self.db_conn.get_binned_data_in_columns('foo', 'bar', 2, sums)
+        self.assertListEqual(counts.tolist(), [[0, 6], [5, 0]])
+
+class TestDbConnectionReplicas(TestCase):
+    """Uses two SQLite files to stand in for a writer and a read replica that has not caught up yet"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.writer_url = f'sqlite:///{self.directory.name}/writer.db'
+        self.reader_url = f'sqlite:///{self.directory.name}/reader.db'
+        self.table_name = 'test_table'
+
+        for url in [self.writer_url, self.reader_url]:
+            db_conn = db_connection.DBConnection(url, self.table_name)
+            db_conn.add_column('foo')
+            db_conn.set_data(1, {'foo': 1.0})
+
+        db_connection.DBConnection(self.writer_url, self.table_name).set_data(1, {'foo': 2.0})
+
+    def tearDown(self):
+        for url in [self.writer_url, self.reader_url]:
+            db_connection._engines.pop(url).dispose()
+        self.directory.cleanup()
+
+    def _get_foo(self, client_id):
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], client_id)
+        return db_conn.get_data_in_columns('foo', 'foo')[0][0]
+
+    def test_reads_go_to_reader(self):
+        self.assertEqual(self._get_foo('client'), 1.0)
+
+    def test_read_your_writes(self):
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], 'client')
+        db_conn.set_data(1, {'foo': 3.0})
+
+        self.assertEqual(self._get_foo('client'), 3.0)
+        self.assertEqual(self._get_foo('other client'), 1.0)
+
+        with mock.patch.object(db_connection, 'STICKY_SECONDS', -1):
+            self.assertEqual(self._get_foo('client'), 1.0)
+
+    def test_reads_stay_on_one_database(self):
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url, self.writer_url], 'client')
+        first = db_conn.get_data_in_columns('foo', 'foo')[0][0]
+
+        for _ in range(3):
+            self.assertEqual(db_conn.get_data_in_columns('foo', 'foo')[0][0], first)
+
+    def test_get_all_columns_from_writer(self):
+        db_connection.DBConnection(self.writer_url, self.table_name).add_column('bar')
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], 'other client')
+
+        self.assertListEqual(db_conn.get_all_columns(), ['foo'])
+        self.assertListEqual(db_conn.get_all_columns(from_writer=True), ['foo', 'bar'])
+
+    def test_reads_from_writer(self):
+        self.assertTrue(db_connection.DBConnection(self.writer_url, self.table_name).reads_from_writer)
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], 'client')
+        self.assertFalse(db_conn.reads_from_writer)
+
+        db_conn.set_data(1, {'foo': 3.0})
+        self.assertTrue(db_conn.reads_from_writer)
+        self.assertTrue(db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], 'client').reads_from_writer)
+
+    def test_writes_go_to_writer(self):
+        db_conn = db_connection.DBConnection(self.writer_url, self.table_name, [self.reader_url], 'client')
+        db_conn.add_column('bar')
+
+        self.assertTrue(db_connection.get_safe_column_name('bar') in db_conn._get_table().c)
+        self.assertFalse(db_connection.get_safe_column_name('bar') in db_conn._get_table(db_conn._reader_engines[0]).c)
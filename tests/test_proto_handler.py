@@ -1,6 +1,8 @@
 from unittest import TestCase, mock
 
-from correlatr import proto_handler
+import numpy
+
+from correlatr import column_stats, compact, db_connection, proto_handler
 from protos import client_pb2, shared_pb2
 
 class TestProtoHandler(TestCase):
@@ -43,3 +45,123 @@ class TestProtoHandler(TestCase):
         for key, value in proto_handler.ProtoHandler('')._dictify_datapoints(datapoints).items():
             self.assertTrue(key in expected_result)
             self.assertAlmostEqual(expected_result[key], value, 5)
+
+
+    @mock.patch.object(proto_handler, "DBConnection")
+    def test_discover_request_cached(self, mock_db_connection_class):
+        mock_db_conn = mock_db_connection_class.return_value
+        mock_db_conn.url = "foo"
+        mock_db_conn.table_name = "test_discover_request_cached"
+        mock_db_conn.data_version = 0
+        mock_db_conn.reads_from_writer = True
+        values = numpy.column_stack([numpy.arange(5.0), numpy.arange(5.0) * 2])
+        mock_db_conn.get_all_data.return_value = (numpy.arange(5.0), ["foo", "bar"], values)
+
+        discover_proto = client_pb2.ClientMessage()
+        discover_proto.discoverRequest.topK = 3
+        response = proto_handler.ProtoHandler("foo").handle_proto(discover_proto)
+        proto_handler.ProtoHandler("foo").handle_proto(discover_proto)
+
+        self.assertFalse(response.statusMessage.error)
+        self.assertEqual(len(response.correlations), 1)
+        mock_db_conn.get_all_data.assert_called_once()
+
+        mock_db_conn.data_version = 1
+        proto_handler.ProtoHandler("foo").handle_proto(discover_proto)
+        self.assertEqual(mock_db_conn.get_all_data.call_count, 2)
+
+        #Replicas may be behind the data version, so what is read from them is not cached
+        mock_db_conn.data_version = 2
+        mock_db_conn.reads_from_writer = False
+        proto_handler.ProtoHandler("foo").handle_proto(discover_proto)
+        proto_handler.ProtoHandler("foo").handle_proto(discover_proto)
+        self.assertEqual(mock_db_conn.get_all_data.call_count, 4)
+
+    @mock.patch.object(proto_handler, "DBConnection")
+    def test_update_data_compact(self, mock_db_connection_class):
+        mock_db_conn = mock_db_connection_class.return_value
+        columns = ["foo", "bar", "baz"]
+        mock_db_conn.get_all_columns.return_value = columns
+
+        update_data_proto = client_pb2.ClientMessage()
+        compact_row = update_data_proto.updateData.compactData
+        compact_row.dictionaryVersion = compact.dictionary_version(columns)
+        compact_row.columnIndexes.extend([2, 0])
+        compact_row.values, compact_row.nullBitmap = compact.pack_values([None, 1.5])
+        update_data_proto.updateData.date = 1000
+        proto_handler.ProtoHandler("foo").handle_proto(update_data_proto)
+        mock_db_conn.set_data.assert_called_once_with(1, {"baz": None, "foo": 1.5})
+        mock_db_conn.get_all_columns.assert_called_once_with(from_writer=True)
+
+        compact_row.dictionaryVersion += 1
+        response = proto_handler.ProtoHandler("foo").handle_proto(update_data_proto)
+        self.assertTrue(response.statusMessage.error)
+        mock_db_conn.set_data.assert_called_once()
+
+    @mock.patch.object(proto_handler, "DBConnection")
+    def test_update_data_compact_malformed(self, mock_db_connection_class):
+        mock_db_conn = mock_db_connection_class.return_value
+        columns = ["foo", "bar", "baz"]
+        mock_db_conn.get_all_columns.return_value = columns
+        values, null_bitmap = compact.pack_values([1.0, 2.0])
+
+        for indexes, values, null_bitmap in [([0, 1], values, b''), ([0, 1], values[:-3], null_bitmap),
+                ([0, 0], values, null_bitmap), ([0, 3], values, null_bitmap), ([0], values, null_bitmap)]:
+            update_data_proto = client_pb2.ClientMessage()
+            compact_row = update_data_proto.updateData.compactData
+            compact_row.dictionaryVersion = compact.dictionary_version(columns)
+            compact_row.columnIndexes.extend(indexes)
+            compact_row.values, compact_row.nullBitmap = values, null_bitmap
+            response = proto_handler.ProtoHandler("foo").handle_proto(update_data_proto)
+            self.assertTrue(response.statusMessage.error)
+            self.assertTrue(response.statusMessage.text.startswith("Malformed compact row"))
+
+        mock_db_conn.set_data.assert_not_called()
+
+    @mock.patch.object(proto_handler, "DBConnection")
+    def test_image_request_binned(self, mock_db_connection_class):
+        mock_db_conn = mock_db_connection_class.return_value
+        mock_db_conn.get_column_pair_sums.return_value = db_connection.ColumnPairSums(
+            count=10, sum_x=45.0, sum_y=100.0, sum_xx=285.0, sum_xy=615.0, min_x=0.0, max_x=9.0, min_y=1.0, max_y=19.0)
+        counts = numpy.eye(proto_handler.HISTOGRAM_BINS, dtype=int)
+        mock_db_conn.get_binned_data_in_columns.return_value = (numpy.linspace(0, 9, proto_handler.HISTOGRAM_BINS + 1),
+            numpy.linspace(1, 19, proto_handler.HISTOGRAM_BINS + 1), counts)
+
+        graph_proto = client_pb2.ClientMessage()
+        graph_proto.graphRequest.horizontal = "foo"
+        graph_proto.graphRequest.vertical = "bar"
+        response = proto_handler.ProtoHandler("foo", max_scatter_points=5).handle_proto(graph_proto)
+
+        self.assertFalse(response.statusMessage.error)
+        self.assertTrue(response.graphImage)
+        mock_db_conn.get_data_in_columns.assert_not_called()
+        mock_db_conn.get_binned_data_in_columns.assert_called_once()
+
+    def test_linear_fit(self):
+        sums = db_connection.ColumnPairSums(
+            count=10, sum_x=45.0, sum_y=100.0, sum_xx=285.0, sum_xy=615.0, min_x=0.0, max_x=9.0, min_y=1.0, max_y=19.0)
+        slope, intercept = proto_handler._linear_fit(sums)
+        self.assertAlmostEqual(slope, 2.0)
+        self.assertAlmostEqual(intercept, 1.0)
+
+        constant_x = sums._replace(sum_xx=202.5)
+        self.assertEqual(proto_handler._linear_fit(constant_x), (None, None))
+
+    @mock.patch.object(proto_handler, "DBConnection")
+    def test_column_stats_request(self, mock_db_connection_class):
+        mock_db_conn = mock_db_connection_class.return_value
+        foo_stats = column_stats.compute_stats([(1, 1.0), (2, 3.0)])
+        mock_db_conn.get_column_stats.return_value = [("foo", foo_stats), ("bar", column_stats.empty_stats())]
+
+        column_stats_proto = client_pb2.ClientMessage()
+        column_stats_proto.columnStatsRequest.SetInParent()
+        response = proto_handler.ProtoHandler("foo").handle_proto(column_stats_proto)
+
+        self.assertFalse(response.statusMessage.error)
+        self.assertEqual(len(response.columnStats), 2)
+        foo, bar = response.columnStats
+        self.assertEqual((foo.columnName, foo.count, foo.min, foo.max, foo.lastValue), ("foo", 2, 1.0, 3.0, 3.0))
+        self.assertAlmostEqual(foo.mean, 2.0)
+        self.assertAlmostEqual(foo.stddev, 2 ** 0.5)
+        self.assertEqual((foo.firstDate, foo.lastDate), (1000, 2000))
+        self.assertEqual((bar.columnName, bar.count), ("bar", 0))
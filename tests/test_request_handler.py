@@ -10,7 +10,7 @@ class TestRequestHandler(TestCase):
         proto.changeColumn.newColumnName = "foo"
 
         mock_proto_handler = mock.MagicMock()
-        def mock_proto_handler_class(_):
+        def mock_proto_handler_class(_, **kwargs):
             return mock_proto_handler
 
         with mock.patch.object(request_handler, "ProtoHandler", mock_proto_handler_class):
@@ -0,0 +1,119 @@
+import threading
+from unittest import TestCase, mock
+
+from correlatr import scheduler
+from protos import client_pb2
+
+class TestScheduler(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.limits = {
+            'cheap': scheduler.ClassLimits(concurrency=1, queue_size=1, max_wait=0.1, cost=1),
+            'write': scheduler.ClassLimits(concurrency=1, queue_size=1, max_wait=0.1, cost=1),
+            'expensive': scheduler.ClassLimits(concurrency=1, queue_size=0, max_wait=0.1, cost=5),
+        }
+        self.scheduler = scheduler.Scheduler(self.limits, client_rate=1, client_burst=10, clock=lambda: self.now)
+        self.ping = client_pb2.ClientMessage()
+        self.ping.ping.SetInParent()
+        self.graph = client_pb2.ClientMessage()
+        self.graph.graphRequest.horizontal = "foo"
+
+    def test_submit(self):
+        handler = mock.MagicMock()
+        result = self.scheduler.submit("client", self.ping, handler)
+        handler.assert_called_once_with(self.ping)
+        self.assertEqual(result, handler.return_value)
+        self.assertEqual(self.scheduler.stats()['cheap']['completed'], 1)
+
+    def test_submit_rate_limited(self):
+        handler = mock.MagicMock()
+        self.scheduler.submit("client", self.graph, handler)
+        self.scheduler.submit("client", self.graph, handler)
+        result = self.scheduler.submit("client", self.graph, handler)
+
+        self.assertEqual(handler.call_count, 2)
+        self.assertTrue(result.statusMessage.error)
+        self.assertIn("retry after 5 seconds", result.statusMessage.text)
+        self.assertEqual(self.scheduler.stats()['expensive']['rate_limited'], 1)
+        self.assertEqual(self.scheduler.stats()['expensive']['rejected'], 0)
+
+        #Other clients have their own bucket
+        self.scheduler.submit("other client", self.graph, handler)
+        self.assertEqual(handler.call_count, 3)
+
+        self.now = 5.0
+        self.scheduler.submit("client", self.graph, handler)
+        self.assertEqual(handler.call_count, 4)
+
+    def test_submit_sheds_expensive_without_blocking_cheap(self):
+        started = threading.Event()
+        release = threading.Event()
+        def slow_handler(_):
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=self.scheduler.submit, args=("a", self.graph, slow_handler))
+        thread.start()
+        started.wait()
+
+        result = self.scheduler.submit("b", self.graph, mock.MagicMock())
+        self.assertTrue(result.statusMessage.error)
+        self.assertIn("Server busy", result.statusMessage.text)
+        self.assertEqual(self.scheduler.stats()['expensive']['rejected'], 1)
+        self.assertEqual(self.scheduler.stats()['expensive']['rate_limited'], 0)
+
+        handler = mock.MagicMock()
+        self.scheduler.submit("b", self.ping, handler)
+        handler.assert_called_once()
+        self.assertEqual(self.scheduler.stats()['expensive']['in_flight'], 1)
+
+        release.set()
+        thread.join()
+        self.assertEqual(self.scheduler.stats()['expensive']['in_flight'], 0)
+
+    def test_submit_shed_messages_are_free(self):
+        started = threading.Event()
+        release = threading.Event()
+        def slow_handler(_):
+            started.set()
+            release.wait()
+
+        thread = threading.Thread(target=self.scheduler.submit, args=("a", self.graph, slow_handler))
+        thread.start()
+        started.wait()
+        for _ in range(3):
+            self.scheduler.submit("b", self.graph, mock.MagicMock())
+        release.set()
+        thread.join()
+
+        #"b" was turned away three times for load, but still has its whole burst
+        handler = mock.MagicMock()
+        self.scheduler.submit("b", self.graph, handler)
+        self.scheduler.submit("b", self.graph, handler)
+        self.assertEqual(handler.call_count, 2)
+        self.assertEqual(self.scheduler.stats()['expensive']['rejected'], 3)
+
+    def test_column_changes_do_not_block_writes(self):
+        schedule = scheduler.Scheduler(clock=lambda: self.now)
+        started = threading.Event()
+        release = threading.Event()
+        def slow_handler(_):
+            started.set()
+            release.wait()
+
+        change_column = client_pb2.ClientMessage()
+        change_column.changeColumn.newColumnName = "foo"
+        thread = threading.Thread(target=schedule.submit, args=("a", change_column, slow_handler))
+        thread.start()
+        started.wait()
+
+        update_data = client_pb2.ClientMessage()
+        update_data.updateData.date = 1
+        handler = mock.MagicMock()
+        schedule.submit("b", update_data, handler)
+        handler.assert_called_once()
+        self.assertEqual(schedule.stats()['schema']['in_flight'], 1)
+        self.assertEqual(schedule.stats()['write']['in_flight'], 0)
+
+        release.set()
+        thread.join()